@@ -1,4 +1,9 @@
 DB_PATH = "db/mygo.db"
+EMBEDDING_CACHE_PATH = "db/embedding_cache.db"
+ENTITY_INDEX_PATH = "db/entity_index"
+GRAPH_SNAPSHOT_PATH = "db/graph_snapshot"
+GRAPH_PPR_PATH = "db/graph_ppr"
+LLM_CACHE_PATH = "db/llm_cache.db"
 CHAT_MODEL = "qwen2.5-7b-instruct-1m"
 EMBEDD_MODEL = "text-embedding-nomic-embed-text-v1.5@f32"
 BASE_URL = "http://127.0.0.1:1234/v1"
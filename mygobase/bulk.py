@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from typing import Any, Dict, Iterable, List, Sequence
+
+import numpy as np
+import sqlite_vec
+
+from mygobase import DB_PATH
+
+# Applied to every connection that writes in bulk. WAL with synchronous=NORMAL
+# only syncs at checkpoints; cache_size is in KiB when negative.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+BULK_BATCH_SIZE = 10_000
+# Prepared statements kept per connection, keyed by SQL text.
+STATEMENT_CACHE = 256
+
+type Row = Sequence[Any]
+
+
+def tune(conn: sqlite3.Connection):
+    for name, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {name}={value}")
+
+
+def connect(
+    path: str = DB_PATH, vec: bool = True, check_same_thread: bool = True
+) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        path, check_same_thread=check_same_thread, cached_statements=STATEMENT_CACHE
+    )
+    if vec:
+        conn.enable_load_extension(True)
+        sqlite_vec.load(conn)
+        conn.enable_load_extension(False)
+    tune(conn)
+    return conn
+
+
+class BulkWriter:
+    # Buffers rows per statement and writes them with executemany, one
+    # transaction per flush. Statements run in the order they were first
+    # added, so deletes queued before inserts still happen first.
+    def __init__(
+        self, conn: sqlite3.Connection, batch_size: int = BULK_BATCH_SIZE
+    ) -> None:
+        self.conn = conn
+        self.batch_size = batch_size
+        self.pending: Dict[str, List[Row]] = {}
+        self.buffered = 0
+        self.written = 0
+
+    def add(self, statement: str, row: Row):
+        self.pending.setdefault(statement, []).append(row)
+        self.buffered += 1
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def extend(self, statement: str, rows: Iterable[Row]):
+        for row in rows:
+            self.add(statement, row)
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            for statement, rows in self.pending.items():
+                self.conn.executemany(statement, rows)
+        self.written += self.buffered
+        self.pending = {}
+        self.buffered = 0
+
+    def __enter__(self) -> "BulkWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.pending = {}
+            self.buffered = 0
+
+
+GRAPH_SCHEMA = [
+    """
+    CREATE TABLE ner (
+                id INTEGER PRIMARY KEY,
+                scene INT NOT NULL,
+                ner JSON NOT NULL
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE entity_embedding USING vec0(
+        entity TEXT PRIMARY KEY,
+        embedding FLOAT[{dim}] distance_metric=cosine
+    )
+    """,
+    """
+    CREATE TABLE entity (
+            entity TEXT PRIMARY KEY,
+            content JSON NOT NULL
+    )
+    """,
+]
+
+
+def synthetic_graph(entities: int, dim: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    names = [f"entity-{i}" for i in range(entities)]
+    embeddings = rng.standard_normal((entities, dim), dtype=np.float32)
+    content = json.dumps({"contents": [{"title": "t", "content": "A:line\n" * 8}]})
+    relations = json.dumps(
+        {"relations": [{"source": "a", "target": "b", "relation": "r"}] * 3}
+    )
+    ner = [(i, relations) for i in range(entities // 4)]
+    return names, embeddings, content, ner
+
+
+def bench(path: str, entities: int, dim: int, bulk: bool) -> float:
+    names, embeddings, content, ner = synthetic_graph(entities, dim)
+    conn = sqlite3.connect(path)
+    conn.enable_load_extension(True)
+    sqlite_vec.load(conn)
+    conn.enable_load_extension(False)
+    for statement in GRAPH_SCHEMA:
+        conn.execute(statement.format(dim=dim))
+    rows = 2 * entities + len(ner)
+    start = time.perf_counter()
+    if bulk:
+        tune(conn)
+        with BulkWriter(conn) as writer:
+            writer.extend(
+                "INSERT INTO entity_embedding (entity, embedding) VALUES (?, ?)",
+                zip(names, map(np.ndarray.tobytes, embeddings)),
+            )
+            writer.extend(
+                "INSERT INTO entity (entity, content) VALUES (?, ?)",
+                ((name, content) for name in names),
+            )
+            writer.extend("INSERT INTO ner (scene, ner) VALUES (?, ?)", ner)
+    else:
+        # What ner.py did: default pragmas, one execute per row.
+        with conn:
+            for name, embedding in zip(names, embeddings):
+                conn.execute(
+                    "INSERT INTO entity_embedding (entity, embedding) VALUES (?, ?)",
+                    (name, embedding.tobytes()),
+                )
+                conn.execute(
+                    "INSERT INTO entity (entity, content) VALUES (?, ?)",
+                    (name, content),
+                )
+            for row in ner:
+                conn.execute("INSERT INTO ner (scene, ner) VALUES (?, ?)", row)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return rows / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=768)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, bulk in [("per-row", False), ("bulk", True)]:
+            rate = bench(os.path.join(tmp, f"{name}.db"), args.entities, args.dim, bulk)
+            print(f"{name:>8}: {rate:,.0f} rows/sec")
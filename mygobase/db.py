@@ -1,6 +1,12 @@
+import json
+import re
 import sqlite3
+from collections import defaultdict
+from typing import Dict, List, Tuple
 
-import sqlite_vec
+from mygobase import DB_PATH, versions
+from mygobase.bulk import connect
+from mygobase.script import load_df, load_scenes
 
 statements = [
     """
@@ -37,21 +43,309 @@ statements = [
     """
     CREATE VIRTUAL TABLE entity_embedding USING vec0(
         entity TEXT PRIMARY KEY,
-        embedding FLOAT[768]
+        embedding FLOAT[768] distance_metric=cosine
     );
 """,
     """
     CREATE TABLE IF NOT EXISTS entity (
             entity TEXT PRIMARY KEY,
-            content JSON NOT NULL
+            scenes JSON NOT NULL
     );
+""",
+    """
+    CREATE TABLE IF NOT EXISTS frames (
+                id INTEGER PRIMARY KEY,
+                episode INT NOT NULL,
+                frame_number INT NOT NULL
+    );
+""",
+    """
+    CREATE TABLE IF NOT EXISTS frame_pictures (
+                frame INT NOT NULL,
+                tier TEXT NOT NULL,
+                codec TEXT NOT NULL,
+                picture BLOB NOT NULL,
+                PRIMARY KEY (frame, tier),
+                FOREIGN KEY(frame) REFERENCES frames(id)
+    );
+""",
+    """
+    ALTER TABLE storyboards ADD COLUMN frame INT REFERENCES frames(id)
+""",
+    """
+    CREATE TABLE IF NOT EXISTS frame_hashes (
+                frame INTEGER PRIMARY KEY,
+                hash INT NOT NULL,
+                h0 INT NOT NULL,
+                h1 INT NOT NULL,
+                h2 INT NOT NULL,
+                h3 INT NOT NULL,
+                FOREIGN KEY(frame) REFERENCES frames(id)
+    );
+""",
+    """
+    CREATE INDEX IF NOT EXISTS idx_frame_hashes_h0 ON frame_hashes (h0);
+""",
+    """
+    CREATE INDEX IF NOT EXISTS idx_frame_hashes_h1 ON frame_hashes (h1);
+""",
+    """
+    CREATE INDEX IF NOT EXISTS idx_frame_hashes_h2 ON frame_hashes (h2);
+""",
+    """
+    CREATE INDEX IF NOT EXISTS idx_frame_hashes_h3 ON frame_hashes (h3);
+""",
+    """
+    CREATE INDEX IF NOT EXISTS idx_storyboards_frame ON storyboards (frame);
+""",
+    """
+    CREATE INDEX IF NOT EXISTS idx_frames_episode ON frames (episode);
+""",
+    """
+    CREATE TABLE IF NOT EXISTS ingest_manifest (
+                episode INTEGER PRIMARY KEY,
+                video_path TEXT NOT NULL,
+                video_size INT NOT NULL,
+                video_mtime REAL NOT NULL,
+                video_digest TEXT NOT NULL,
+                sub_path TEXT NOT NULL,
+                sub_size INT NOT NULL,
+                sub_mtime REAL NOT NULL,
+                sub_digest TEXT NOT NULL
+    );
+""",
+    """
+    ALTER TABLE ner ADD COLUMN digest TEXT
+""",
+    """
+    ALTER TABLE ner ADD COLUMN entities JSON
+""",
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_ner_scene ON ner (scene);
+""",
+    """
+    CREATE TABLE IF NOT EXISTS entity_dirty (
+            entity TEXT PRIMARY KEY
+    );
+""",
+    """
+    CREATE TABLE IF NOT EXISTS scenes (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            script TEXT NOT NULL
+    );
+""",
+    """
+    CREATE TABLE IF NOT EXISTS frame_crop_hashes (
+                frame INT NOT NULL,
+                crop INT NOT NULL,
+                hash INT NOT NULL,
+                h0 INT NOT NULL,
+                h1 INT NOT NULL,
+                h2 INT NOT NULL,
+                h3 INT NOT NULL,
+                PRIMARY KEY (frame, crop),
+                FOREIGN KEY(frame) REFERENCES frames(id)
+    );
+""",
+    """
+    CREATE INDEX IF NOT EXISTS idx_frame_crop_hashes_h0 ON frame_crop_hashes (h0);
+""",
+    """
+    CREATE INDEX IF NOT EXISTS idx_frame_crop_hashes_h1 ON frame_crop_hashes (h1);
+""",
+    """
+    CREATE INDEX IF NOT EXISTS idx_frame_crop_hashes_h2 ON frame_crop_hashes (h2);
+""",
+    """
+    CREATE INDEX IF NOT EXISTS idx_frame_crop_hashes_h3 ON frame_crop_hashes (h3);
+""",
+    """
+    CREATE TABLE IF NOT EXISTS graph_nodes (
+            entity TEXT PRIMARY KEY
+    ) WITHOUT ROWID;
+""",
+    """
+    CREATE TABLE IF NOT EXISTS graph_edges (
+            source TEXT NOT NULL,
+            target TEXT NOT NULL,
+            weight INT NOT NULL,
+            scenes JSON NOT NULL,
+            relations JSON NOT NULL,
+            PRIMARY KEY (source, target)
+    ) WITHOUT ROWID;
+""",
+    """
+    CREATE INDEX IF NOT EXISTS idx_graph_edges_target ON graph_edges (target, source);
+""",
+    """
+    CREATE TABLE IF NOT EXISTS graph_version (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            version JSON NOT NULL
+    );
+""",
+    """
+    CREATE TABLE IF NOT EXISTS versions (
+            name TEXT PRIMARY KEY,
+            version INT NOT NULL
+    ) WITHOUT ROWID;
 """,
 ]
-with sqlite3.connect("db/mygo.db") as conn:
-    conn.enable_load_extension(True)
-    sqlite_vec.load(conn)
-    conn.enable_load_extension(False)
 
+
+def migrate_pictures(conn: sqlite3.Connection):
+    # Older databases keep the encoded frame (always PNG) inline in
+    # storyboards.picture. Move it into frame_pictures so scans over
+    # storyboards stay on small rows.
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(storyboards)")}
+    if "picture" not in columns:
+        return
+    with conn:
+        conn.execute(
+            "INSERT INTO frames (id, episode, frame_number) SELECT id, episode, frame_number FROM storyboards"
+        )
+        conn.execute(
+            "INSERT INTO frame_pictures (frame, tier, codec, picture) SELECT id, 'full', 'png', picture FROM storyboards"
+        )
+        conn.execute("UPDATE storyboards SET frame = id")
+        conn.execute("ALTER TABLE storyboards DROP COLUMN picture")
+    conn.execute("VACUUM")
+    print("migrated storyboards.picture to frame_pictures")
+
+
+def migrate_unique_storyboards(conn: sqlite3.Connection):
+    # Re-running ingestion used to insert every line again. Drop those copies
+    # (and frames nothing points at anymore) before enforcing uniqueness.
+    if conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_storyboards_unique'"
+    ).fetchone():
+        return
+    with conn:
+        conn.execute(
+            """
+            DELETE FROM storyboards
+            WHERE id NOT IN (
+                SELECT MIN(id) FROM storyboards GROUP BY episode, frame_number, subtitle
+            )
+            """
+        )
+        for table, column in [
+            ("frame_hashes", "frame"),
+            ("frame_crop_hashes", "frame"),
+            ("frame_pictures", "frame"),
+        ]:
+            conn.execute(
+                f"DELETE FROM {table} WHERE {column} NOT IN (SELECT frame FROM storyboards WHERE frame IS NOT NULL)"
+            )
+        conn.execute(
+            "DELETE FROM frames WHERE id NOT IN (SELECT frame FROM storyboards WHERE frame IS NOT NULL)"
+        )
+        conn.execute(
+            "CREATE UNIQUE INDEX idx_storyboards_unique ON storyboards (episode, frame_number, subtitle)"
+        )
+    print("statement ok: CREATE UNIQUE INDEX idx_storyboards_unique")
+
+
+def migrate_cosine_embeddings(conn: sqlite3.Connection):
+    # vec0 fixes the distance metric at creation. Tables made before KNN
+    # search used the default L2, so rebuild them with cosine distance.
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'entity_embedding'"
+    ).fetchone()
+    if row is None or "distance_metric=cosine" in row[0]:
+        return
+    dim = re.search(r"FLOAT\[(\d+)\]", row[0], re.IGNORECASE)
+    with conn:
+        conn.execute(
+            "CREATE TEMP TABLE entity_embedding_old AS SELECT entity, embedding FROM entity_embedding"
+        )
+        conn.execute("DROP TABLE entity_embedding")
+        conn.execute(
+            f"""
+            CREATE VIRTUAL TABLE entity_embedding USING vec0(
+                entity TEXT PRIMARY KEY,
+                embedding FLOAT[{dim.group(1) if dim else 768}] distance_metric=cosine
+            )
+            """
+        )
+        conn.execute(
+            "INSERT INTO entity_embedding (entity, embedding) SELECT entity, embedding FROM temp.entity_embedding_old"
+        )
+        conn.execute("DROP TABLE temp.entity_embedding_old")
+        versions.bump(conn, versions.EMBEDDING)
+    print("migrated entity_embedding to cosine distance")
+
+
+def scenes_by_script(conn: sqlite3.Connection) -> Dict[str, List[int]]:
+    # Scene ids by the script ner.py makes of them.
+    res: Dict[str, List[int]] = defaultdict(list)
+    for scene_id, script in load_scenes(load_df(conn)):
+        if scene_id is not None:
+            res[script].append(scene_id)
+    return res
+
+
+def migrate_scene_store(conn: sqlite3.Connection):
+    # entity.content used to hold a copy of every scene script the entity
+    # appears in. Keep each script once in scenes and only the scene ids on
+    # the entity. The ner rows of those databases do not say which entities a
+    # scene has, so contents are matched to scenes by script text, as ner.py
+    # builds scripts from the storyboards, and every entity is left dirty for
+    # ner.py to rebuild.
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(entity)")}
+    if "content" not in columns:
+        return
+    by_script = scenes_by_script(conn)
+    scenes: Dict[int, Tuple[str, str]] = {}
+    rows: List[Tuple[str, str]] = []
+    dirty: List[Tuple[str]] = []
+    # Contents whose script is not in the storyboards anymore.
+    unmatched = 0
+    for entity, content in conn.execute("SELECT entity, content FROM entity"):
+        scene_ids: List[int] = []
+        for c in json.loads(content)["contents"]:
+            matches = by_script.get(c["content"], [])
+            unmatched += not matches
+            for scene_id in matches:
+                scenes.setdefault(scene_id, (c["title"], c["content"]))
+                if scene_id not in scene_ids:
+                    scene_ids.append(scene_id)
+        scene_ids.sort()
+        dirty.append((entity,))
+        rows.append((entity, json.dumps(scene_ids)))
+    with conn:
+        conn.execute(
+            "CREATE TABLE entity_new (entity TEXT PRIMARY KEY, scenes JSON NOT NULL)"
+        )
+        conn.executemany("INSERT INTO entity_new (entity, scenes) VALUES (?, ?)", rows)
+        if unmatched:
+            # Nothing else holds those scripts; keep them around.
+            conn.execute("ALTER TABLE entity RENAME TO entity_legacy")
+        else:
+            conn.execute("DROP TABLE entity")
+        conn.execute("ALTER TABLE entity_new RENAME TO entity")
+        conn.executemany(
+            "INSERT OR IGNORE INTO scenes (id, title, script) VALUES (?, ?, ?)",
+            [(scene_id, *scene) for scene_id, scene in scenes.items()],
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO entity_dirty (entity) VALUES (?)", dirty
+        )
+        versions.bump(conn, versions.GRAPH)
+    if unmatched:
+        print(
+            f"{unmatched} scene scripts matched no scene, "
+            "the old table is kept as entity_legacy"
+        )
+    else:
+        conn.execute("VACUUM")
+    print(
+        f"migrated entity.content to {len(scenes)} scenes, "
+        f"{len(dirty)} entities left to rebuild"
+    )
+
+
+def migrate(conn: sqlite3.Connection):
     cursor = conn.cursor()
     for statement in statements:
         try:
@@ -61,3 +355,12 @@ with sqlite3.connect("db/mygo.db") as conn:
             print(e)
         else:
             print(f"statement ok: {statement}")
+    migrate_pictures(conn)
+    migrate_unique_storyboards(conn)
+    migrate_cosine_embeddings(conn)
+    migrate_scene_store(conn)
+
+
+if __name__ == "__main__":
+    with connect(DB_PATH) as conn:
+        migrate(conn)
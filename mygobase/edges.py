@@ -0,0 +1,43 @@
+import json
+import sqlite3
+from collections import Counter, defaultdict
+from typing import Container, Dict, List, NamedTuple, Set, Tuple
+
+from mygobase.llmtools.er import Entity
+
+# Relation texts kept per edge, most frequent first.
+RELATION_SAMPLES = 3
+
+
+class Edge(NamedTuple):
+    source: Entity
+    target: Entity
+    # Number of scenes the relation between source and target shows up in.
+    weight: int
+    scenes: List[int]
+    relations: List[str]
+
+
+def collapse_edges(conn: sqlite3.Connection, entities: Container[Entity]) -> List[Edge]:
+    # Every extracted relation between two known entities, folded into one
+    # edge per (source, target) however many scenes repeat it.
+    texts: Dict[Tuple[Entity, Entity], Counter[str]] = defaultdict(Counter)
+    scenes: Dict[Tuple[Entity, Entity], Set[int]] = defaultdict(set)
+    for scene_id, relations_json in conn.execute(
+        "SELECT scene, ner FROM ner ORDER BY scene"
+    ):
+        for relation in json.loads(relations_json)["relations"]:
+            source, target = relation["source"], relation["target"]
+            if source in entities and target in entities:
+                texts[source, target][relation["relation"]] += 1
+                scenes[source, target].add(scene_id)
+    return [
+        Edge(
+            source,
+            target,
+            len(scenes[source, target]),
+            sorted(scenes[source, target]),
+            [text for text, _ in counter.most_common(RELATION_SAMPLES)],
+        )
+        for (source, target), counter in texts.items()
+    ]
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import sqlite3
+from typing import List, Optional, Self, Tuple
+
+import numpy as np
+
+from mygobase import ENTITY_INDEX_PATH, sidecar, versions
+from mygobase.llmtools.er import Entity
+from mygobase.pool import default_pool
+
+type Version = int
+
+
+def version(conn: sqlite3.Connection) -> Version:
+    return versions.get(conn, versions.EMBEDDING)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+class EntityIndex:
+    # All entity embeddings as one L2-normalized float32 matrix, so cosine
+    # similarity for a batch of queries is a single matmul. The matrix and the
+    # names of its rows are published together as one sidecar build next to
+    # the database (see sidecar.py); both are memory-mapped on load.
+    def __init__(
+        self, names: sidecar.Strings, matrix: np.ndarray, version: Version
+    ) -> None:
+        self.names = names
+        self.matrix = matrix
+        self.version = version
+
+    @classmethod
+    def build(cls, conn: sqlite3.Connection, path: str = ENTITY_INDEX_PATH) -> Self:
+        current = version(conn)
+        names: List[Entity] = []
+        blobs: List[bytes] = []
+        for entity, embedding in conn.execute(
+            "SELECT entity, embedding FROM entity_embedding"
+        ):
+            names.append(entity)
+            blobs.append(embedding)
+        if blobs:
+            matrix = normalize(
+                np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), -1)
+            ).astype(np.float32)
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        with sidecar.publish(path) as build:
+            np.save(os.path.join(build, "matrix.npy"), matrix)
+            sidecar.write_strings(build, "names", names)
+            with open(os.path.join(build, "meta.json"), "w") as f:
+                json.dump({"version": current}, f)
+        return cls.load(path)  # type: ignore
+
+    @classmethod
+    def read(cls, build: str) -> Self:
+        with open(os.path.join(build, "meta.json")) as f:
+            meta = json.load(f)
+        matrix = np.load(os.path.join(build, "matrix.npy"), mmap_mode="r")
+        return cls(sidecar.read_strings(build, "names"), matrix, meta["version"])
+
+    @classmethod
+    def load(cls, path: str = ENTITY_INDEX_PATH) -> Optional[Self]:
+        return sidecar.read(path, cls.read)
+
+    @classmethod
+    def open(
+        cls, conn: sqlite3.Connection, path: str = ENTITY_INDEX_PATH
+    ) -> Optional[Self]:
+        # None without a current sidecar, so callers keep searching in SQLite.
+        # Only ner.py (or running this module) rebuilds it.
+        index = cls.load(path)
+        if index is None:
+            return None
+        if index.version != version(conn):
+            print("entity index is stale, searching entity_embedding instead")
+            return None
+        return index
+
+    def search(
+        self, queries: np.ndarray, k: int, threshold: float
+    ) -> List[List[Tuple[Entity, float]]]:
+        # queries: (n, dim) -> for each query, up to k (entity, cosine) pairs
+        # above threshold, best first.
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if len(self.names) == 0:
+            return [[] for _ in queries]
+        scores = normalize(queries) @ self.matrix.T
+        k = min(k, len(self.names))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        return [
+            [
+                (self.names[i], float(score))
+                for i, score in zip(row, row_scores)
+                if score >= threshold
+            ]
+            for row, row_scores in zip(top, top_scores)
+        ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", default=ENTITY_INDEX_PATH)
+    args = parser.parse_args()
+    with default_pool().connection() as conn:
+        index = EntityIndex.build(conn, args.path)
+    print(f"indexed {len(index.names)} entities, matrix {index.matrix.shape}")
@@ -1,17 +1,97 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import queue
 import sqlite3
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from dataclasses import dataclass
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 from datetime import timedelta
 from pathlib import Path
-from typing import List, Tuple
+from typing import (
+    Callable,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 import ass  # type: ignore
 import cv2
+import numpy as np
 from tqdm import tqdm  # type: ignore
 
+from mygobase import DB_PATH
+from mygobase.bulk import BulkWriter, connect
+from mygobase.frame_index import (
+    INSERT_CROP_HASH,
+    INSERT_HASH,
+    crop_hash_rows,
+    hash_rows,
+)
+from mygobase.picture import (
+    FULL,
+    THUMBNAIL,
+    Codec,
+    ImageFormat,
+    Tier,
+    TierName,
+    crop_dhashes,
+    dhash,
+    encode,
+    hamming,
+)
+from mygobase.scene import scene_ids, segment, thumbnail
+
 FRAME_TIME = 24000 / 1001
+# Seeking makes the decoder restart from the previous keyframe, so it only pays
+# off when the next wanted frame is further away than one GOP.
+GOP_SIZE = 250
+ENCODE_WORKERS = os.cpu_count() or 4
+INGEST_PROCESSES = 4
+BATCH_SIZE = 64
+DEDUP_DISTANCE = 4
+# Seconds between the end of the kept frame's lines and the start of the next
+# frame's lines under which it may be folded; further apart it is another shot
+# that only happens to look alike.
+DEDUP_GAP = 1.0
 type FrameNumber = int
 type Subtitle = str
+# Pictures by tier and the crop fingerprints of one frame.
+type Encoding = Tuple[Dict[TierName, bytes], List[int]]
+type PendingFrame = Tuple[FrameNumber, FrameNumber, int, np.ndarray, Future[Encoding]]
+# Seconds from the first line shown on a frame starts to the last one ends.
+type Span = Tuple[float, float]
+
+
+class Line(NamedTuple):
+    frame_number: FrameNumber
+    subtitle: Subtitle
+    # Seconds from the start of the episode.
+    start: float
+    end: float
+
+
+class EncodedFrame(NamedTuple):
+    frame_number: FrameNumber
+    # Equal to frame_number unless the frame was folded into a near-identical
+    # earlier one, whose pictures and fingerprint are reused.
+    source_frame: FrameNumber
+    fingerprint: int
+    # dHashes of windows of the picture, see crop_dhashes.
+    crop_fingerprints: List[int]
+    # Tiny downsample of this very frame, used for scene segmentation.
+    thumbnail: np.ndarray
+    pictures: Dict[TierName, bytes]
 
 
 @dataclass
@@ -19,6 +99,48 @@ class Storyboard:
     frame_number: FrameNumber
     subtitle: Subtitle
     picture: bytes
+    codec: Codec = Codec.PNG
+    # Downscaled encodings of the same frame, keyed by tier name.
+    tiers: Dict[TierName, bytes] = field(default_factory=dict)
+    # Frame the pictures were taken from, when this frame was folded into a
+    # near-identical earlier one.
+    source_frame: Optional[FrameNumber] = None
+    # dHash of the stored picture, indexed for reverse frame lookup.
+    fingerprint: Optional[int] = None
+    scene: Optional[int] = None
+    # dHashes of windows of the stored picture, so cropped screenshots are
+    # found too.
+    crop_fingerprints: List[int] = field(default_factory=list)
+
+    @classmethod
+    def from_encoded(
+        cls, encoded: EncodedFrame, subtitle: Subtitle, codec: Codec = Codec.PNG
+    ) -> "Storyboard":
+        pictures = encoded.pictures
+        tiers = {name: pic for name, pic in pictures.items() if name != FULL.name}
+        source_frame = (
+            encoded.source_frame
+            if encoded.source_frame != encoded.frame_number
+            else None
+        )
+        return cls(
+            encoded.frame_number,
+            subtitle,
+            pictures[FULL.name],
+            codec,
+            tiers,
+            source_frame,
+            encoded.fingerprint,
+            crop_fingerprints=encoded.crop_fingerprints,
+        )
+
+    @property
+    def picture_frame(self) -> FrameNumber:
+        return self.frame_number if self.source_frame is None else self.source_frame
+
+    @property
+    def pictures(self) -> Dict[TierName, bytes]:
+        return {FULL.name: self.picture, **self.tiers}
 
 
 @dataclass
@@ -27,6 +149,82 @@ class Episode:
     storyboards: List[Storyboard]
 
 
+@dataclass
+class SourceFile:
+    path: str
+    size: int
+    mtime: float
+    digest: str
+
+    @classmethod
+    def scan(cls, path: str, previous: Optional["SourceFile"] = None) -> "SourceFile":
+        st = os.stat(path)
+        # Only hash the file when size or mtime moved since the last ingest.
+        if (
+            previous is not None
+            and previous.size == st.st_size
+            and previous.mtime == st.st_mtime
+        ):
+            return replace(previous, path=path)
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "blake2b").hexdigest()
+        return cls(path, st.st_size, st.st_mtime, digest)
+
+
+@dataclass
+class ManifestEntry:
+    episode: int
+    video: SourceFile
+    sub: SourceFile
+
+    def same_content(self, other: Optional["ManifestEntry"]) -> bool:
+        return (
+            other is not None
+            and self.video.digest == other.video.digest
+            and self.sub.digest == other.sub.digest
+        )
+
+
+def staging_episode(epid: int) -> int:
+    # Rows of an episode being re-ingested are written under this id and only
+    # swapped in once the whole episode is written. Until then (or after a
+    # crash, until the next StoryboardWriter cleans up) they sit in the shared
+    # tables, so readers only look at episode >= 0.
+    return -1 - epid
+
+
+@dataclass
+class StageStats:
+    frames: int = 0
+    seconds: float = 0.0
+
+    @property
+    def fps(self) -> float:
+        return self.frames / self.seconds if self.seconds else 0.0
+
+
+@dataclass
+class PipelineStats:
+    workers: int = 1
+    decode: StageStats = field(default_factory=StageStats)
+    encode: StageStats = field(default_factory=StageStats)
+    duplicates: int = 0
+
+    @property
+    def dedup_ratio(self) -> float:
+        return self.duplicates / self.decode.frames if self.decode.frames else 0.0
+
+    def __str__(self) -> str:
+        # encode.seconds is summed over all workers, so scale by the pool size
+        # to get the throughput of the whole stage.
+        return (
+            f"decode: {self.decode.fps:.1f} fps, "
+            f"encode: {self.encode.fps * self.workers:.1f} fps "
+            f"({self.encode.fps:.1f} fps x {self.workers} workers), "
+            f"dedup: {self.duplicates}/{self.decode.frames} ({self.dedup_ratio:.1%})"
+        )
+
+
 def find_ep_id(filename: str) -> int:
     name = Path(filename).stem
     name = name.replace("[Nekomoe kissaten] BanG Dream! It’s MyGO!!!!! ", "").replace(
@@ -38,24 +236,161 @@ def find_ep_id(filename: str) -> int:
     return id
 
 
-def extrac_picture(filename: str, frame_nums: List[FrameNumber]) -> List[bytes]:
-    fn_table = {frame_num: frame_num for frame_num in frame_nums}
-    frame_num = -1
-    res = []
-    print(f"start read:{filename}")
+def read_frames(
+    filename: str, frame_nums: List[FrameNumber], gop_size: int = GOP_SIZE
+) -> Generator[Tuple[FrameNumber, cv2.typing.MatLike], None, None]:
+    targets = sorted({frame_num for frame_num in frame_nums if frame_num >= 0})
     cap = cv2.VideoCapture(filename)
-    print("read finish")
-    with tqdm(total=len(fn_table)) as pbar:
-        while cap.isOpened():
-            frame_num += 1
+    pos = 0
+    seekable = True
+    try:
+        for target in targets:
+            if seekable and target - pos > gop_size:
+                if cap.set(cv2.CAP_PROP_POS_FRAMES, target) and (
+                    int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == target
+                ):
+                    pos = target
+                else:
+                    # Where the decoder ended up is unknown, so start over and
+                    # grab every frame from here on.
+                    seekable = False
+                    cap.release()
+                    cap = cv2.VideoCapture(filename)
+                    pos = 0
+            while pos < target:
+                if not cap.grab():
+                    return
+                pos += 1
             ret, frame = cap.read()
             if not ret:
-                break
-            if frame_num not in fn_table:
+                return
+            pos += 1
+            yield target, frame
+    finally:
+        cap.release()
+
+
+def iter_encoded(
+    filename: str,
+    frame_nums: List[FrameNumber],
+    workers: int = ENCODE_WORKERS,
+    stats: Optional[PipelineStats] = None,
+    fmt: ImageFormat = ImageFormat(),
+    tiers: Sequence[Tier] = (FULL,),
+    dedup_distance: Optional[int] = None,
+    spans: Optional[Dict[FrameNumber, Span]] = None,
+    dedup_gap: float = DEDUP_GAP,
+) -> Iterator[EncodedFrame]:
+    # With dedup_distance set, a frame within that Hamming distance of the last
+    # kept frame and at most dedup_gap seconds after the frame before it is not
+    # encoded and reuses the pictures of the kept frame instead. The gap is
+    # between the lines of the two frames in spans, or the frames themselves
+    # without them.
+    stats = stats if stats is not None else PipelineStats()
+    stats.workers = workers
+    # Bounds the frames that are decoded but not yet handed back to the caller.
+    pending: queue.Queue[Optional[PendingFrame]] = queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+    lock = threading.Lock()
+    errors: List[BaseException] = []
+
+    def encode_frame(frame: cv2.typing.MatLike) -> Encoding:
+        start = time.perf_counter()
+        pictures = encode(frame, fmt, tiers)
+        crops = crop_dhashes(frame)
+        with lock:
+            stats.encode.frames += 1
+            stats.encode.seconds += time.perf_counter() - start
+        return pictures, crops
+
+    def span(frame_num: FrameNumber) -> Span:
+        if spans is not None and frame_num in spans:
+            return spans[frame_num]
+        return frame_num / FRAME_TIME, frame_num / FRAME_TIME
+
+    def put(item: Optional[PendingFrame]) -> bool:
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
                 continue
-            frame_bytes = cv2.imencode(".png", frame)[1].tobytes()
-            res.append(frame_bytes)
+        return False
+
+    def decode(executor: ThreadPoolExecutor):
+        frames = read_frames(filename, frame_nums)
+        kept: Optional[PendingFrame] = None
+        # Frame number of the previous frame, folded or kept.
+        last: Optional[FrameNumber] = None
+        try:
+            while True:
+                start = time.perf_counter()
+                item = next(frames, None)
+                stats.decode.seconds += time.perf_counter() - start
+                if item is None:
+                    break
+                stats.decode.frames += 1
+                frame_num, frame = item
+                fingerprint = dhash(frame)
+                thumb = thumbnail(frame)
+                previous, last = last, frame_num
+                if (
+                    dedup_distance is not None
+                    and kept is not None
+                    and previous is not None
+                    and hamming(fingerprint, kept[2]) <= dedup_distance
+                    and span(frame_num)[0] - span(previous)[1] <= dedup_gap
+                ):
+                    stats.duplicates += 1
+                    if not put((frame_num, kept[1], kept[2], thumb, kept[4])):
+                        break
+                    continue
+                kept = (
+                    frame_num,
+                    frame_num,
+                    fingerprint,
+                    thumb,
+                    executor.submit(encode_frame, frame),
+                )
+                if not put(kept):
+                    break
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            frames.close()
+            put(None)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        decoder = threading.Thread(target=decode, args=(executor,), daemon=True)
+        decoder.start()
+        try:
+            while (item := pending.get()) is not None:
+                frame_num, source_num, fingerprint, thumb, future = item
+                pictures, crops = future.result()
+                yield EncodedFrame(
+                    frame_num, source_num, fingerprint, crops, thumb, pictures
+                )
+        finally:
+            stop.set()
+            decoder.join()
+    if errors:
+        raise errors[0]
+
+
+def extrac_picture(
+    filename: str,
+    frame_nums: List[FrameNumber],
+    workers: int = ENCODE_WORKERS,
+    fmt: ImageFormat = ImageFormat(),
+) -> List[bytes]:
+    res = []
+    stats = PipelineStats()
+    print(f"start read:{filename}")
+    with tqdm(total=len(set(frame_nums))) as pbar:
+        for encoded in iter_encoded(filename, frame_nums, workers, stats, fmt):
+            res.append(encoded.pictures[FULL.name])
             pbar.update(1)
+    print(f"{filename}: {stats}")
     return res
 
 
@@ -67,10 +402,10 @@ def clear_subtitle(subtitle: str) -> str:
     return subtitle
 
 
-def extract_fn_and_sub(filename: str) -> List[Tuple[FrameNumber, Subtitle]]:
+def extract_lines(filename: str) -> List[Line]:
     with open(filename, encoding="utf_8_sig") as f:
         doc = ass.parse(f)
-    storyboards: List[Tuple[FrameNumber, Subtitle]] = []
+    lines: List[Line] = []
     for d in doc.events:
         d: ass.Dialogue  # type: ignore
         if d.style != "Dial_CH":
@@ -84,38 +419,474 @@ def extract_fn_and_sub(filename: str) -> List[Tuple[FrameNumber, Subtitle]]:
 
         # find sub
         subtitle = clear_subtitle(str(d.text))
-        storyboards.append((frame_number, subtitle))
-    return storyboards
+        lines.append(
+            Line(
+                frame_number,
+                subtitle,
+                start_time.total_seconds(),
+                end_time.total_seconds(),
+            )
+        )
+    return lines
+
+
+def extract_fn_and_sub(filename: str) -> List[Tuple[FrameNumber, Subtitle]]:
+    return [(line.frame_number, line.subtitle) for line in extract_lines(filename)]
 
 
-def extract_storyboard(epid: int, video_filename: str, sub_filename: str) -> Episode:
+def line_spans(lines: List[Line]) -> Dict[FrameNumber, Span]:
+    spans: Dict[FrameNumber, Span] = {}
+    for line in lines:
+        start, end = spans.get(line.frame_number, (line.start, line.end))
+        spans[line.frame_number] = (min(start, line.start), max(end, line.end))
+    return spans
+
+
+def segment_scenes(
+    frames: List[Tuple[FrameNumber, np.ndarray]], lines: List[Line]
+) -> Dict[FrameNumber, int]:
+    # Local scene index per decoded frame, from the thumbnails collected while
+    # decoding and the timing of the lines shown on each frame.
+    if not frames:
+        return {}
+    spans = line_spans(lines)
+    frame_numbers = [fn for fn, _ in frames]
+    local = segment(
+        np.stack([thumb for _, thumb in frames]),
+        np.array([spans[fn][0] for fn in frame_numbers]),
+        np.array([spans[fn][1] for fn in frame_numbers]),
+    )
+    return dict(zip(frame_numbers, local.tolist()))
+
+
+def global_scenes(epid: int, local: Dict[FrameNumber, int]) -> Dict[FrameNumber, int]:
+    return dict(zip(local.keys(), scene_ids(epid, np.array(list(local.values())))))
+
+
+def extract_storyboard(
+    epid: int,
+    video_filename: str,
+    sub_filename: str,
+    encode_workers: int = ENCODE_WORKERS,
+    fmt: ImageFormat = ImageFormat(),
+    tiers: Sequence[Tier] = (FULL,),
+    dedup_distance: Optional[int] = DEDUP_DISTANCE,
+    dedup_gap: float = DEDUP_GAP,
+) -> Episode:
     print((video_filename, sub_filename))
-    fn_sub_pairs = extract_fn_and_sub(sub_filename)
+    lines = extract_lines(sub_filename)
+    fn_sub_pairs = [(line.frame_number, line.subtitle) for line in lines]
     frame_numbers = list(map(lambda x: x[0], fn_sub_pairs))
-    pcis = extrac_picture(video_filename, frame_numbers)
+    stats = PipelineStats()
+    encoded = {
+        frame.frame_number: frame
+        for frame in iter_encoded(
+            video_filename,
+            frame_numbers,
+            encode_workers,
+            stats,
+            fmt,
+            tiers,
+            dedup_distance,
+            line_spans(lines),
+            dedup_gap,
+        )
+    }
+    print(f"episode {epid}: {stats}")
+    scenes = global_scenes(
+        epid,
+        segment_scenes([(fn, frame.thumbnail) for fn, frame in encoded.items()], lines),
+    )
     storyboards: List[Storyboard] = []
-    for (fn, sub), pic in zip(fn_sub_pairs, pcis):
-        storyboards.append(Storyboard(frame_number=fn, subtitle=sub, picture=pic))
+    for fn, sub in dict.fromkeys(fn_sub_pairs):
+        if fn not in encoded:
+            continue
+        storyboard = Storyboard.from_encoded(encoded[fn], sub, fmt.codec)
+        storyboard.scene = scenes[fn]
+        storyboards.append(storyboard)
     episode = Episode(id=epid, storyboards=storyboards)
     return episode
 
 
+class StoryboardWriter:
+    def __init__(self, path: str = DB_PATH, batch_size: int = BATCH_SIZE) -> None:
+        self.conn = connect(path, vec=False)
+        self.batch_size = batch_size
+        # Flushed explicitly once per batch, never on its own.
+        self.writer = BulkWriter(self.conn, batch_size=sys.maxsize)
+        # Frame ids already written, so storyboards sharing a picture (same
+        # frame number or a deduplicated one) point at a single frames row.
+        self.frame_ids: Dict[Tuple[int, FrameNumber], int] = {}
+        # Leftovers of an interrupted run.
+        with self.conn:
+            for (episode,) in self.conn.execute(
+                "SELECT DISTINCT episode FROM frames WHERE episode < 0"
+            ).fetchall():
+                self.discard_episode(episode)
+
+    def write(self, epid: int, storyboards: List[Storyboard]):
+        for start in range(0, len(storyboards), self.batch_size):
+            batch = storyboards[start : start + self.batch_size]
+            # This is the only writer, so frame ids can be assigned up front
+            # and every table filled in one transaction.
+            (next_id,) = self.conn.execute(
+                "SELECT COALESCE(MAX(id), 0) + 1 FROM frames"
+            ).fetchone()
+            new_frames: List[Tuple[int, Storyboard]] = []
+            for sb in batch:
+                key = (epid, sb.picture_frame)
+                if key not in self.frame_ids:
+                    self.frame_ids[key] = next_id
+                    new_frames.append((next_id, sb))
+                    next_id += 1
+            self.writer.extend(
+                "INSERT INTO frames (id, episode, frame_number) VALUES (?,?,?)",
+                [(id, epid, sb.picture_frame) for id, sb in new_frames],
+            )
+            self.writer.extend(
+                "INSERT INTO frame_pictures (frame, tier, codec, picture) VALUES (?,?,?,?)",
+                [
+                    (id, tier, sb.codec.value, pic)
+                    for id, sb in new_frames
+                    for tier, pic in sb.pictures.items()
+                ],
+            )
+            self.writer.extend(
+                INSERT_HASH,
+                hash_rows(
+                    (id, sb.fingerprint)
+                    for id, sb in new_frames
+                    if sb.fingerprint is not None
+                ),
+            )
+            self.writer.extend(
+                INSERT_CROP_HASH,
+                crop_hash_rows((id, sb.crop_fingerprints) for id, sb in new_frames),
+            )
+            self.writer.extend(
+                "INSERT INTO storyboards (episode, frame_number, subtitle, frame, scene) VALUES (?,?,?,?,?)",
+                [
+                    (
+                        epid,
+                        sb.frame_number,
+                        sb.subtitle,
+                        self.frame_ids[(epid, sb.picture_frame)],
+                        sb.scene,
+                    )
+                    for sb in batch
+                ],
+            )
+            self.writer.flush()
+
+    def discard_episode(self, epid: int):
+        for statement in [
+            "DELETE FROM frame_hashes WHERE frame IN (SELECT id FROM frames WHERE episode = ?)",
+            "DELETE FROM frame_crop_hashes WHERE frame IN (SELECT id FROM frames WHERE episode = ?)",
+            "DELETE FROM frame_pictures WHERE frame IN (SELECT id FROM frames WHERE episode = ?)",
+            "DELETE FROM storyboards WHERE episode = ?",
+            "DELETE FROM frames WHERE episode = ?",
+        ]:
+            self.conn.execute(statement, (epid,))
+        for key in [key for key in self.frame_ids if key[0] == epid]:
+            del self.frame_ids[key]
+
+    def replace_episode(
+        self,
+        epid: int,
+        manifest: Optional[ManifestEntry] = None,
+        scenes: Optional[Dict[FrameNumber, int]] = None,
+    ):
+        staged = staging_episode(epid)
+        with self.conn:
+            if scenes:
+                self.conn.executemany(
+                    "UPDATE storyboards SET scene = ? WHERE episode = ? AND frame_number = ?",
+                    [(scene, staged, fn) for fn, scene in scenes.items()],
+                )
+            # Keep hand-labelled roles for lines that survived the re-ingest.
+            self.conn.execute(
+                """
+                UPDATE storyboards AS new
+                SET role = old.role
+                FROM storyboards AS old
+                WHERE
+                    new.episode = ?
+                    AND old.episode = ?
+                    AND old.frame_number = new.frame_number
+                    AND old.subtitle = new.subtitle
+                """,
+                (staged, epid),
+            )
+            self.discard_episode(epid)
+            self.conn.execute(
+                "UPDATE frames SET episode = ? WHERE episode = ?", (epid, staged)
+            )
+            self.conn.execute(
+                "UPDATE storyboards SET episode = ? WHERE episode = ?", (epid, staged)
+            )
+            if manifest is not None:
+                self.save_manifest(manifest)
+        for key in [key for key in self.frame_ids if key[0] == staged]:
+            self.frame_ids[(epid, key[1])] = self.frame_ids.pop(key)
+
+    def load_manifest(self, epid: int) -> Optional[ManifestEntry]:
+        row = self.conn.execute(
+            """
+            SELECT
+                video_path, video_size, video_mtime, video_digest,
+                sub_path, sub_size, sub_mtime, sub_digest
+            FROM
+                ingest_manifest
+            WHERE
+                episode = ?
+            """,
+            (epid,),
+        ).fetchone()
+        if row is None:
+            return None
+        return ManifestEntry(epid, SourceFile(*row[:4]), SourceFile(*row[4:]))
+
+    def save_manifest(self, manifest: ManifestEntry):
+        video, sub = manifest.video, manifest.sub
+        self.conn.execute(
+            "INSERT OR REPLACE INTO ingest_manifest VALUES (?,?,?,?,?,?,?,?,?)",
+            (
+                manifest.episode,
+                video.path,
+                video.size,
+                video.mtime,
+                video.digest,
+                sub.path,
+                sub.size,
+                sub.mtime,
+                sub.digest,
+            ),
+        )
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self) -> "StoryboardWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 def store_db(ep: Episode):
-    epid = ep.id
-    data = [(epid, sb.frame_number, sb.subtitle, sb.picture) for sb in ep.storyboards]
-    with sqlite3.connect("db/mygo.db") as conn:
+    with StoryboardWriter() as writer:
         try:
-            cursor = conn.cursor()
-            cursor.executemany(
-                "INSERT INTO storyboards (episode, frame_number, subtitle, picture) VALUES (?,?,?,?)",
-                data,
-            )
-            conn.commit()
+            writer.write(staging_episode(ep.id), ep.storyboards)
+            writer.replace_episode(ep.id)
         except sqlite3.OperationalError as e:
             print(e)
 
 
+def ingest_episode(
+    epid: int,
+    video_filename: str,
+    sub_filename: str,
+    batches: "queue.Queue[Tuple[int, Optional[List[Storyboard]]]]",
+    batch_size: int = BATCH_SIZE,
+    encode_workers: int = ENCODE_WORKERS,
+    fmt: ImageFormat = ImageFormat(),
+    tiers: Sequence[Tier] = (FULL,),
+    dedup_distance: Optional[int] = DEDUP_DISTANCE,
+    dedup_gap: float = DEDUP_GAP,
+) -> Dict[FrameNumber, int]:
+    # Streams storyboards to the writer and returns the local scene index of
+    # every frame, which is only known once the whole episode is decoded.
+    lines = extract_lines(sub_filename)
+    subtitles: Dict[FrameNumber, List[Subtitle]] = defaultdict(list)
+    for line in lines:
+        if line.subtitle not in subtitles[line.frame_number]:
+            subtitles[line.frame_number].append(line.subtitle)
+    stats = PipelineStats()
+    batch: List[Storyboard] = []
+    thumbnails: List[Tuple[FrameNumber, np.ndarray]] = []
+    count = 0
+    for encoded in iter_encoded(
+        video_filename,
+        list(subtitles.keys()),
+        encode_workers,
+        stats,
+        fmt,
+        tiers,
+        dedup_distance,
+        line_spans(lines),
+        dedup_gap,
+    ):
+        thumbnails.append((encoded.frame_number, encoded.thumbnail))
+        batch.extend(
+            Storyboard.from_encoded(encoded, sub, fmt.codec)
+            for sub in subtitles[encoded.frame_number]
+        )
+        if len(batch) >= batch_size:
+            batches.put((epid, batch))
+            count += len(batch)
+            batch = []
+    if batch:
+        batches.put((epid, batch))
+        count += len(batch)
+    scenes = segment_scenes(thumbnails, lines)
+    print(
+        f"episode {epid}: {count} storyboards, "
+        f"{len(set(scenes.values()))} scenes, {stats}"
+    )
+    return scenes
+
+
+def end_marker(
+    epid: int, batches: "queue.Queue[Tuple[int, Optional[List[Storyboard]]]]"
+) -> Callable[["Future[Dict[FrameNumber, int]]"], None]:
+    # Done callback telling the writer an episode has no more batches.
+    # Cancelled episodes (see abandon) need no end marker.
+    def put(future: "Future[Dict[FrameNumber, int]]"):
+        if not future.cancelled():
+            batches.put((epid, None))
+
+    return put
+
+
+def abandon(
+    executor: ProcessPoolExecutor,
+    futures: Dict[int, "Future[Dict[FrameNumber, int]]"],
+    batches: "queue.Queue[Tuple[int, Optional[List[Storyboard]]]]",
+    ended: Set[int],
+):
+    # The writer is gone, but running workers may be blocked on the bounded
+    # queue and leaving the executor waits for them: cancel what has not
+    # started and throw batches away until the rest have finished. Done
+    # callbacks run after a future is done and may block on the queue too, so
+    # keep going until the end marker of every episode not cancelled is in.
+    executor.shutdown(wait=False, cancel_futures=True)
+    while any(
+        epid not in ended and not future.cancelled() for epid, future in futures.items()
+    ):
+        try:
+            epid, storyboards = batches.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if storyboards is None:
+            ended.add(epid)
+
+
+def ingest(
+    episodes: List[Tuple[int, str, str]],
+    processes: int = INGEST_PROCESSES,
+    batch_size: int = BATCH_SIZE,
+    encode_workers: int = max(1, ENCODE_WORKERS // INGEST_PROCESSES),
+    fmt: ImageFormat = ImageFormat(),
+    tiers: Sequence[Tier] = (FULL,),
+    dedup_distance: Optional[int] = DEDUP_DISTANCE,
+    dedup_gap: float = DEDUP_GAP,
+    force: bool = False,
+):
+    with (
+        multiprocessing.Manager() as manager,
+        StoryboardWriter(batch_size=batch_size) as writer,
+    ):
+        manifests: Dict[int, ManifestEntry] = {}
+        for epid, video_filename, sub_filename in episodes:
+            previous = writer.load_manifest(epid)
+            manifest = ManifestEntry(
+                epid,
+                SourceFile.scan(
+                    video_filename, previous.video if previous is not None else None
+                ),
+                SourceFile.scan(
+                    sub_filename, previous.sub if previous is not None else None
+                ),
+            )
+            if not force and manifest.same_content(previous):
+                if manifest != previous:
+                    with writer.conn:
+                        writer.save_manifest(manifest)
+                continue
+            manifests[epid] = manifest
+        print(f"{len(manifests)} of {len(episodes)} episodes changed")
+
+        # Workers block once this many batches are waiting for the writer, so
+        # memory stays bounded by the batch size rather than the season size.
+        batches = manager.Queue(maxsize=2 * processes)
+        futures: Dict[int, Future[Dict[FrameNumber, int]]] = {}
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for epid, manifest in manifests.items():
+                future = executor.submit(
+                    ingest_episode,
+                    staging_episode(epid),
+                    manifest.video.path,
+                    manifest.sub.path,
+                    batches,
+                    batch_size,
+                    encode_workers,
+                    fmt,
+                    tiers,
+                    dedup_distance,
+                    dedup_gap,
+                )
+                future.add_done_callback(end_marker(epid, batches))
+                futures[epid] = future
+
+            ended: Set[int] = set()
+            try:
+                with tqdm(desc="writing storyboards") as pbar:
+                    while len(ended) < len(futures):
+                        epid, storyboards = batches.get()
+                        if storyboards is not None:
+                            writer.write(epid, storyboards)
+                            pbar.update(len(storyboards))
+                            continue
+                        ended.add(epid)
+                        e = futures[epid].exception()
+                        if e is None:
+                            try:
+                                scenes = global_scenes(epid, futures[epid].result())
+                            except ValueError as error:
+                                e = error
+                        if e is None:
+                            writer.replace_episode(epid, manifests[epid], scenes)
+                        else:
+                            print(f"episode {epid} failed: {e}")
+                            with writer.conn:
+                                writer.discard_episode(staging_episode(epid))
+            except BaseException:
+                abandon(executor, futures, batches, ended)
+                raise
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--codec", type=Codec, choices=list(Codec), default=Codec.PNG)
+    parser.add_argument("--quality", type=int, default=90)
+    parser.add_argument(
+        "--thumbnail-width",
+        type=int,
+        default=None,
+        help="also store a downscaled tier of this width",
+    )
+    parser.add_argument(
+        "--dedup-distance",
+        type=int,
+        default=DEDUP_DISTANCE,
+        help="max dHash Hamming distance to fold a frame into the previous one, -1 disables",
+    )
+    parser.add_argument(
+        "--dedup-gap",
+        type=float,
+        default=DEDUP_GAP,
+        help="max seconds between the lines of a frame and the one it is folded into",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="re-ingest episodes whose source files are unchanged",
+    )
+    args = parser.parse_args()
+    tiers: List[Tier] = [FULL]
+    if args.thumbnail_width is not None:
+        tiers.append(Tier(THUMBNAIL.name, width=args.thumbnail_width))
+
     video_filenames = []
     for dirpath, _, filenames in Path("./videos").walk():
         for filename in filenames:
@@ -131,20 +902,17 @@ if __name__ == "__main__":
             sub_filenames.append(filename)
     sub_filenames.sort(key=find_ep_id)
 
-    episodes: List[Episode] = []
-    futures = []
     print(video_filenames)
-    input()
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        for epid, (video_filename, sub_filename) in enumerate(
-            zip(video_filenames, sub_filenames), start=13
-        ):
-            futures.append(
-                executor.submit(extract_storyboard, epid, video_filename, sub_filename)
+    ingest(
+        [
+            (epid, video_filename, sub_filename)
+            for epid, (video_filename, sub_filename) in enumerate(
+                zip(video_filenames, sub_filenames), start=13
             )
-    for future in as_completed(futures):
-        assert not future.cancelled()
-        episodes.append(future.result())
-    print(f"Extracted {len(episodes)} episodes")
-    for episode in episodes:
-        store_db(episode)
+        ],
+        fmt=ImageFormat(args.codec, args.quality),
+        tiers=tiers,
+        dedup_distance=args.dedup_distance if args.dedup_distance >= 0 else None,
+        dedup_gap=args.dedup_gap,
+        force=args.force,
+    )
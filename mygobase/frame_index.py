@@ -0,0 +1,215 @@
+import argparse
+import sqlite3
+from dataclasses import dataclass
+from itertools import combinations
+from typing import Dict, Iterable, List, Tuple
+
+import cv2
+import numpy as np
+from tqdm import tqdm  # type: ignore
+
+from mygobase import DB_PATH
+from mygobase.picture import FULL, crop_dhashes, dhash, hamming
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+MAX_DISTANCE = 15
+
+
+@dataclass
+class FrameMatch:
+    episode: int
+    frame_number: int
+    subtitle: str
+    distance: int
+
+
+def split(fingerprint: int) -> List[int]:
+    mask = (1 << CHUNK_BITS) - 1
+    return [(fingerprint >> (CHUNK_BITS * i)) & mask for i in range(CHUNKS)]
+
+
+def to_signed(fingerprint: int) -> int:
+    # SQLite integers are signed 64-bit.
+    return (
+        fingerprint - (1 << HASH_BITS)
+        if fingerprint >> (HASH_BITS - 1)
+        else fingerprint
+    )
+
+
+INSERT_HASH = "INSERT OR REPLACE INTO frame_hashes (frame, hash, h0, h1, h2, h3) VALUES (?,?,?,?,?,?)"
+
+
+def hash_rows(rows: Iterable[Tuple[int, int]]) -> List[Tuple[int, ...]]:
+    return [(frame, to_signed(fp), *split(fp)) for frame, fp in rows]
+
+
+def add_hashes(conn: sqlite3.Connection, rows: Iterable[Tuple[int, int]]):
+    conn.executemany(INSERT_HASH, hash_rows(rows))
+
+
+INSERT_CROP_HASH = "INSERT OR REPLACE INTO frame_crop_hashes (frame, crop, hash, h0, h1, h2, h3) VALUES (?,?,?,?,?,?,?)"
+
+
+def crop_hash_rows(rows: Iterable[Tuple[int, List[int]]]) -> List[Tuple[int, ...]]:
+    return [
+        (frame, crop, to_signed(fp), *split(fp))
+        for frame, fps in rows
+        for crop, fp in enumerate(fps)
+    ]
+
+
+def add_crop_hashes(conn: sqlite3.Connection, rows: Iterable[Tuple[int, List[int]]]):
+    conn.executemany(INSERT_CROP_HASH, crop_hash_rows(rows))
+
+
+def ring(value: int, radius: int) -> List[int]:
+    res = []
+    for bits in combinations(range(CHUNK_BITS), radius):
+        flipped = value
+        for bit in bits:
+            flipped ^= 1 << bit
+        res.append(flipped)
+    return res
+
+
+def search_hash(
+    conn: sqlite3.Connection,
+    fingerprint: int,
+    k: int = 5,
+    max_distance: int = MAX_DISTANCE,
+) -> List[FrameMatch]:
+    # Multi-index hashing: a hash within distance d of the query agrees with it
+    # to within d // CHUNKS bits on at least one of the CHUNKS substrings, so
+    # probing every substring index out to radius r finds every frame within
+    # CHUNKS * (r + 1) - 1 bits. Widen r until k frames are known to be closest.
+    # A frame is as close as the nearer of its whole picture and its crops.
+    query = split(fingerprint)
+    distances: Dict[int, int] = {}
+    for radius in range(max_distance // CHUNKS + 1):
+        for i, value in enumerate(query):
+            probes = ring(value, radius)
+            for table in ["frame_hashes", "frame_crop_hashes"]:
+                # Frames of negative (staged, see staging_episode) episodes
+                # are not ingested yet.
+                for frame, stored in conn.execute(
+                    f"""
+                    SELECT
+                        {table}.frame,
+                        {table}.hash
+                    FROM
+                        {table}
+                        JOIN frames ON frames.id = {table}.frame
+                    WHERE
+                        {table}.h{i} IN ({",".join("?" * len(probes))})
+                        AND frames.episode >= 0
+                    """,
+                    probes,
+                ):
+                    distance = hamming(fingerprint, stored & ((1 << HASH_BITS) - 1))
+                    if distance <= min(max_distance, distances.get(frame, HASH_BITS)):
+                        distances[frame] = distance
+        complete = min(CHUNKS * (radius + 1) - 1, max_distance)
+        if sum(1 for d in distances.values() if d <= complete) >= k:
+            break
+
+    frames = sorted(distances, key=distances.__getitem__)[:k]
+    if not frames:
+        return []
+    rows = conn.execute(
+        f"""
+        SELECT
+            frame,
+            episode,
+            frame_number,
+            subtitle
+        FROM
+            storyboards
+        WHERE
+            frame IN ({",".join("?" * len(frames))})
+            AND episode >= 0
+        """,
+        frames,
+    ).fetchall()
+    matches = [
+        FrameMatch(episode, frame_number, subtitle, distances[frame])
+        for frame, episode, frame_number, subtitle in rows
+    ]
+    matches.sort(key=lambda m: (m.distance, m.episode, m.frame_number))
+    return matches[:k]
+
+
+def search(
+    conn: sqlite3.Connection,
+    image: bytes,
+    k: int = 5,
+    max_distance: int = MAX_DISTANCE,
+) -> List[FrameMatch]:
+    frame = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        raise ValueError("image could not be decoded")
+    return search_hash(conn, dhash(frame), k, max_distance)
+
+
+def build(conn: sqlite3.Connection, batch_size: int = 256):
+    # Hash frames ingested before the index (or its crops) existed; frames
+    # written by extract_storyboard are indexed as they are inserted.
+    rows = conn.execute(
+        """
+        SELECT
+            frames.id,
+            frame_pictures.rowid
+        FROM
+            frames
+            JOIN frame_pictures ON frame_pictures.frame = frames.id
+            AND frame_pictures.tier = ?
+            LEFT JOIN frame_hashes ON frame_hashes.frame = frames.id
+        WHERE
+            frame_hashes.frame IS NULL
+            OR NOT EXISTS (
+                SELECT 1 FROM frame_crop_hashes WHERE frame_crop_hashes.frame = frames.id
+            )
+        """,
+        (FULL.name,),
+    ).fetchall()
+    hashes: List[Tuple[int, int]] = []
+    crops: List[Tuple[int, List[int]]] = []
+    unreadable = 0
+    for frame_id, rowid in tqdm(rows, desc="hashing frames"):
+        with conn.blobopen("frame_pictures", "picture", rowid, readonly=True) as blob:
+            data = blob.read()
+        frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            unreadable += 1
+            continue
+        hashes.append((frame_id, dhash(frame)))
+        crops.append((frame_id, crop_dhashes(frame)))
+        if len(hashes) >= batch_size:
+            with conn:
+                add_hashes(conn, hashes)
+                add_crop_hashes(conn, crops)
+            hashes, crops = [], []
+    with conn:
+        add_hashes(conn, hashes)
+        add_crop_hashes(conn, crops)
+    if unreadable:
+        print(f"{unreadable} pictures could not be decoded")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("screenshot", nargs="?", help="image to look up")
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument(
+        "--build", action="store_true", help="index frames that have no hash yet"
+    )
+    args = parser.parse_args()
+    with sqlite3.connect(DB_PATH) as conn:
+        if args.build:
+            build(conn)
+        if args.screenshot:
+            with open(args.screenshot, "rb") as f:
+                for match in search(conn, f.read(), args.k):
+                    print(match)
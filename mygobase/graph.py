@@ -1,96 +1,424 @@
+import argparse
+import json
 import sqlite3
+from abc import ABC, abstractmethod
 from contextlib import contextmanager
-from typing import Dict, List, Optional, Self, Set
+from enum import Enum
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Self, Set, Tuple
 
 import networkx as nx
-import sqlite_vec
+import numpy as np
 
-from mygobase import DB_PATH
+from mygobase import sqlgraph
+from mygobase.edges import Edge, collapse_edges
+from mygobase.entity_index import EntityIndex
 from mygobase.llmtools.embedding import EmbeddingExtractor
-from mygobase.llmtools.er import Entity, EntityRelationExtractor, Relations
-from mygobase.ner import Content, Contents
+from mygobase.llmtools.er import Entity, EntityRelationExtractor
+from mygobase.ner import Content
+from mygobase.pool import default_pool
+from mygobase.ppr import PPRIndex
+from mygobase.snapshot import GraphSnapshot
 
 
 @contextmanager
 def mygobase_connect():
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.enable_load_extension(True)
-        sqlite_vec.load(conn)
-        conn.enable_load_extension(False)
+    with default_pool().connection() as conn:
         yield conn
 
 
-class MyGOKnowledgeGraph:
+def knn(
+    conn: sqlite3.Connection, embedding: np.ndarray, k: int, threshold: float
+) -> List[Tuple[Entity, float]]:
+    # vec0 KNN over entity_embedding (cosine distance, see db.py); the k
+    # nearest come back ordered and only those above threshold survive.
+    return conn.execute(
+        """
+        SELECT
+            entity,
+            1 - distance AS score
+        FROM
+            (
+                SELECT
+                    entity,
+                    distance
+                FROM
+                    entity_embedding
+                WHERE
+                    embedding MATCH ?
+                    AND k = ?
+            )
+        WHERE
+            distance <= ?
+        ORDER BY
+            distance
+        """,
+        (embedding.astype(np.float32).tobytes(), k, 1 - threshold),
+    ).fetchall()
+
+
+# Relations between the query's entities that associate_retrieve expands.
+ASSOCIATE_EDGES = 8
+# How far around the query's entities associate_retrieve looks for more, and
+# how many it adds.
+ASSOCIATE_HOPS = 1
+ASSOCIATE_BUDGET = 8
+
+
+class KnowledgeGraph(ABC):
+    # The queries the retriever runs against the knowledge graph, answered by
+    # MyGOKnowledgeGraph (networkx), SnapshotKnowledgeGraph or SQLKnowledgeGraph.
+    # Entity similarity search is the same for all of them.
+    def __init__(self, index: Optional[EntityIndex] = None) -> None:
+        # Scene texts already read, by scene id.
+        self.scenes: Dict[int, Content] = {}
+        self.embedder = EmbeddingExtractor()
+        # Similarity search runs in memory when the sidecar index exists and is
+        # current, and falls back to vec0 KNN in SQLite otherwise.
+        self.index = index
+
+    @abstractmethod
+    def has_entity(self, entity: Entity) -> bool: ...
+
+    @abstractmethod
+    def search_entity(self, entity: Entity) -> Optional[List[int]]:
+        # Ids of the scenes the entity appears in; load_scenes has the texts.
+        ...
+
+    @abstractmethod
+    def edges_between(self, entities: Set[Entity]) -> Iterator[Edge]: ...
+
+    @abstractmethod
+    def neighbours(self, entity: Entity) -> Set[Entity]:
+        # Entities one edge away, in either direction.
+        ...
+
+    def load_scenes(self, scene_ids: Iterable[int]) -> List[Content]:
+        # Read from the scenes table the first time they are needed.
+        scene_ids = list(scene_ids)
+        missing = [scene_id for scene_id in scene_ids if scene_id not in self.scenes]
+        if missing:
+            with mygobase_connect() as conn:
+                for scene_id, title, script in conn.execute(
+                    f"SELECT id, title, script FROM scenes WHERE id IN ({','.join('?' * len(missing))})",
+                    missing,
+                ):
+                    self.scenes[scene_id] = Content(
+                        scene=scene_id, title=title, content=script
+                    )
+        return [
+            self.scenes[scene_id] for scene_id in scene_ids if scene_id in self.scenes
+        ]
+
+    def k_hop(self, entities: Set[Entity], hops: int) -> Dict[Entity, int]:
+        # Every entity within hops edges of entities (ignoring direction),
+        # mapped to its distance; the known entities themselves are at 0.
+        distances = {entity: 0 for entity in entities if self.has_entity(entity)}
+        frontier = list(distances)
+        for hop in range(1, hops + 1):
+            reached = []
+            for entity in frontier:
+                for neighbour in self.neighbours(entity):
+                    if neighbour not in distances:
+                        distances[neighbour] = hop
+                        reached.append(neighbour)
+            frontier = reached
+        return distances
+
+    def search_similar_entity(
+        self, query: str, k: int = 3, threshold: float = 0.8
+    ) -> List[Entity]:
+        query_embedding = np.asarray(self.embedder.extract(query), dtype=np.float32)
+        return self.search_similar_embedding(query_embedding, k, threshold)
+
+    def search_similar_embedding(
+        self, query_embedding: np.ndarray, k: int = 3, threshold: float = 0.8
+    ) -> List[Entity]:
+        return self.search_similar_embeddings(query_embedding[None], k, threshold)[0]
+
+    def search_similar_embeddings(
+        self, query_embeddings: np.ndarray, k: int = 3, threshold: float = 0.8
+    ) -> List[List[Entity]]:
+        return [
+            [entity for entity, _ in res]
+            for res in self.rank_similar_embeddings(query_embeddings, k, threshold)
+        ]
+
+    def rank_similar_embeddings(
+        self, query_embeddings: np.ndarray, k: int = 3, threshold: float = 0.8
+    ) -> List[List[Tuple[Entity, float]]]:
+        # One (entity, cosine similarity) list per row of query_embeddings.
+        if self.index is not None:
+            return self.index.search(query_embeddings, k, threshold)
+        with mygobase_connect() as conn:
+            return [
+                knn(conn, embedding, k, threshold) for embedding in query_embeddings
+            ]
+
+
+class MyGOKnowledgeGraph(KnowledgeGraph):
+    # The whole graph as a networkx DiGraph built from the tables.
     def __init__(
-        self, graph: nx.MultiDiGraph, entities: Dict[Entity, Contents]
+        self,
+        graph: nx.DiGraph,
+        entities: Dict[Entity, List[int]],
+        index: Optional[EntityIndex] = None,
     ) -> None:
+        super().__init__(index)
         self.graph = graph
+        # entity -> ids of the scenes it appears in.
         self.entities = entities
-        self.embedder = EmbeddingExtractor()
 
     @classmethod
-    def from_db(cls, path: str = "db/mygo.db") -> Self:
-        entities: Dict[Entity, Contents] = {}
+    def from_db(cls, path: str = "db/mygo.db", use_index: bool = True) -> Self:
+        entities: Dict[Entity, List[int]] = {}
         with mygobase_connect() as conn:
-            for entity, content in conn.execute(
-                "SELECT entity, content FROM entity"
+            index = EntityIndex.open(conn) if use_index else None
+            for entity, scene_ids in conn.execute(
+                "SELECT entity, scenes FROM entity"
             ).fetchall():
-                entities[entity] = Contents.model_validate_json(content)
-            graph = nx.MultiDiGraph()
-            for (relations_json_str,) in conn.execute("SELECT ner FROM ner").fetchall():
-                relations = Relations.model_validate_json(relations_json_str)
-                for relation in relations.relations:
-                    try:
-                        assert relation.source in entities, relation.source
-                        assert relation.target in entities, relation.target
-                    except AssertionError:
-                        continue
-                    else:
-                        graph.add_node(
-                            relation.source, contents=entities[relation.source]
-                        )
-                        graph.add_node(
-                            relation.target, contents=entities[relation.target]
-                        )
-                        graph.add_edge(
-                            relation.source, relation.target, relation=relation.relation
-                        )
-        return cls(graph, entities)
-
-    def search_entity(self, entity: Entity) -> Optional[Contents]:
+                entities[entity] = json.loads(scene_ids)
+            # One edge per (source, target), however many scenes relate them.
+            graph = nx.DiGraph()
+            for edge in collapse_edges(conn, entities):
+                graph.add_node(edge.source, scenes=entities[edge.source])
+                graph.add_node(edge.target, scenes=entities[edge.target])
+                graph.add_edge(
+                    edge.source,
+                    edge.target,
+                    weight=edge.weight,
+                    scenes=edge.scenes,
+                    relations=edge.relations,
+                )
+        return cls(graph, entities, index)
+
+    def has_entity(self, entity: Entity) -> bool:
+        return entity in self.graph
+
+    def search_entity(self, entity: Entity) -> Optional[List[int]]:
         if entity in self.graph:
-            return self.graph.nodes[entity]["contents"]
+            return self.graph.nodes[entity]["scenes"]
         return None
 
-    def search_similar_entity(
-        self, query: str, k: int = 3, threshold: float = 0.8
-    ) -> List[Entity]:
-        query_embedding = self.embedder.extract(query)
+    def edges_between(self, entities: Set[Entity]) -> Iterator[Edge]:
+        for source, target, data in self.graph.subgraph(entities).edges(data=True):
+            yield Edge(
+                source, target, data["weight"], data["scenes"], data["relations"]
+            )
+
+    def neighbours(self, entity: Entity) -> Set[Entity]:
+        if entity not in self.graph:
+            return set()
+        return {*self.graph.successors(entity), *self.graph.predecessors(entity)}
+
+
+class SnapshotKnowledgeGraph(KnowledgeGraph):
+    # Answered from a memory-mapped GraphSnapshot; scene texts are decoded
+    # from it the first time they are asked for.
+    def __init__(
+        self, snapshot: GraphSnapshot, index: Optional[EntityIndex] = None
+    ) -> None:
+        super().__init__(index)
+        self.snapshot = snapshot
+
+    def has_entity(self, entity: Entity) -> bool:
+        return self.snapshot.find(entity) is not None
+
+    def search_entity(self, entity: Entity) -> Optional[List[int]]:
+        node = self.snapshot.find(entity)
+        if node is None:
+            return None
+        return self.snapshot.scenes(node)
+
+    def load_scenes(self, scene_ids: Iterable[int]) -> List[Content]:
+        res: List[Content] = []
+        for scene_id in scene_ids:
+            if scene_id not in self.scenes:
+                scene = self.snapshot.scene(scene_id)
+                if scene is None:
+                    continue
+                title, script = scene
+                self.scenes[scene_id] = Content(
+                    scene=scene_id, title=title, content=script
+                )
+            res.append(self.scenes[scene_id])
+        return res
+
+    def edges_between(self, entities: Set[Entity]) -> Iterator[Edge]:
+        nodes = {self.snapshot.find(entity) for entity in entities} - {None}
+        for source in nodes:
+            for target, edge in self.snapshot.out_edges(source):  # type: ignore
+                if target in nodes:
+                    yield self.snapshot.edge(source, target, edge)  # type: ignore
+
+    def neighbours(self, entity: Entity) -> Set[Entity]:
+        node = self.snapshot.find(entity)
+        if node is None:
+            return set()
+        nodes = {target for target, _ in self.snapshot.out_edges(node)}
+        nodes.update(source for source, _ in self.snapshot.in_edges(node))
+        return {self.snapshot.names[node] for node in nodes}
+
+
+class SQLKnowledgeGraph(KnowledgeGraph):
+    # Run against the graph_nodes and graph_edges tables (see sqlgraph.py), so
+    # only the rows a query needs are read; k-hop expansion is a recursive
+    # query.
+
+    def has_entity(self, entity: Entity) -> bool:
+        with mygobase_connect() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM graph_nodes WHERE entity = ?", (entity,)
+            ).fetchone()
+        return row is not None
+
+    def search_entity(self, entity: Entity) -> Optional[List[int]]:
+        with mygobase_connect() as conn:
+            row = conn.execute(
+                """
+                SELECT
+                    entity.scenes
+                FROM
+                    graph_nodes
+                    JOIN entity ON entity.entity = graph_nodes.entity
+                WHERE
+                    graph_nodes.entity = ?
+                """,
+                (entity,),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def edges_between(self, entities: Set[Entity]) -> Iterator[Edge]:
+        names = json.dumps(list(entities), ensure_ascii=False)
+        with mygobase_connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT
+                    source,
+                    target,
+                    weight,
+                    scenes,
+                    relations
+                FROM
+                    graph_edges
+                WHERE
+                    source IN (SELECT value FROM json_each(?))
+                    AND target IN (SELECT value FROM json_each(?))
+                """,
+                (names, names),
+            ).fetchall()
+        for source, target, weight, scenes, relations in rows:
+            yield Edge(
+                source, target, weight, json.loads(scenes), json.loads(relations)
+            )
+
+    def neighbours(self, entity: Entity) -> Set[Entity]:
+        with mygobase_connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT target FROM graph_edges WHERE source = ?
+                UNION
+                SELECT source FROM graph_edges WHERE target = ?
+                """,
+                (entity, entity),
+            ).fetchall()
+        return {neighbour for (neighbour,) in rows}
+
+    def k_hop(self, entities: Set[Entity], hops: int) -> Dict[Entity, int]:
+        # Breadth-first over both edge indexes; UNION drops repeated
+        # (entity, hop) rows, so each level is expanded once.
         with mygobase_connect() as conn:
-            res = conn.execute(
+            rows = conn.execute(
                 """
+                WITH RECURSIVE reach (entity, hop) AS (
+                    SELECT
+                        entity,
+                        0
+                    FROM
+                        graph_nodes
+                    WHERE
+                        entity IN (SELECT value FROM json_each(?))
+                    UNION
+                    SELECT
+                        graph_edges.target,
+                        reach.hop + 1
+                    FROM
+                        reach
+                        JOIN graph_edges ON graph_edges.source = reach.entity
+                    WHERE
+                        reach.hop < ?
+                    UNION
+                    SELECT
+                        graph_edges.source,
+                        reach.hop + 1
+                    FROM
+                        reach
+                        JOIN graph_edges ON graph_edges.target = reach.entity
+                    WHERE
+                        reach.hop < ?
+                )
                 SELECT
                     entity,
-                    1 - vec_distance_cosine(embedding, ?) as score
-                FROM 
-                    entity_embedding
-                ORDER BY 
-                    score DESC
-                LIMIT 
-                    ?
+                    MIN(hop)
+                FROM
+                    reach
+                GROUP BY
+                    entity
                 """,
-                (sqlite_vec.serialize_float32(query_embedding), k),
+                (json.dumps(list(entities), ensure_ascii=False), hops, hops),
             ).fetchall()
-        res = filter(lambda x: x[1] >= threshold, res)
-        return [entity for entity, _ in res]
+        return dict(rows)
+
+
+class GraphBackend(Enum):
+    # networkx graph built from the tables in every process
+    MEMORY = "memory"
+    # memory-mapped compiled snapshot
+    SNAPSHOT = "snapshot"
+    # indexed adjacency tables queried on demand
+    SQL = "sql"
+
+
+def load_graph(
+    use_index: bool = True, backend: GraphBackend = GraphBackend.SNAPSHOT
+) -> KnowledgeGraph:
+    # The snapshot and the adjacency tables are only written by ner.py (or
+    # snapshot.py / sqlgraph.py); a reader finding the one it asked for
+    # missing or stale builds the graph in memory instead.
+    if backend == GraphBackend.MEMORY:
+        return MyGOKnowledgeGraph.from_db(use_index=use_index)
+    with mygobase_connect() as conn:
+        index = EntityIndex.open(conn) if use_index else None
+        if backend == GraphBackend.SQL and sqlgraph.is_current(conn):
+            return SQLKnowledgeGraph(index)
+        if backend == GraphBackend.SNAPSHOT:
+            graph_snapshot = GraphSnapshot.open(conn)
+            if graph_snapshot is not None:
+                return SnapshotKnowledgeGraph(graph_snapshot, index)
+    print(f"{backend.value} graph missing or stale, building the graph in memory")
+    return MyGOKnowledgeGraph.from_db(use_index=use_index)
 
 
 class Context:
-    def __init__(self) -> None:
-        self.contents: Set[Content] = set()
+    # Scenes are collected by id; their texts are only loaded, through
+    # load_scenes, when the context is rendered.
+    def __init__(self, load_scenes: Callable[[Iterable[int]], List[Content]]) -> None:
+        self.load_scenes = load_scenes
+        self.scenes: Set[int] = set()
+        # scene id -> probe that found it -> best similarity through that probe
+        self.scores: Dict[int, Dict[str, float]] = {}
+
+    def add(self, scene_id: int, score: float = 1.0, source: str = ""):
+        self.scenes.add(scene_id)
+        sources = self.scores.setdefault(scene_id, {})
+        sources[source] = max(score, sources.get(source, score))
 
-    def add(self, c: Content):
-        self.contents.add(c)
+    def score(self, scene_id: int) -> float:
+        return max(self.scores.get(scene_id, {}).values(), default=0.0)
+
+    @property
+    def contents(self) -> List[Content]:
+        # Best supported scenes first.
+        return self.load_scenes(sorted(self.scenes, key=self.score, reverse=True))
 
     def generate_context(self):
         res = ""
@@ -98,56 +426,122 @@ class Context:
             res += f"#{c.title}\n\n{c.content}\n\n"
         return res
 
-    def remove(self, c: Content):
-        self.contents.remove(c)
+    def remove(self, scene_id: int):
+        self.scenes.remove(scene_id)
+        self.scores.pop(scene_id, None)
 
 
 class Retriever:
-    def __init__(self) -> None:
-        self.graph = MyGOKnowledgeGraph.from_db()
+    def __init__(
+        self,
+        graph: Optional[KnowledgeGraph] = None,
+        backend: GraphBackend = GraphBackend.SNAPSHOT,
+    ) -> None:
+        self.graph = graph if graph is not None else load_graph(backend=backend)
         self.er_extractor = EntityRelationExtractor()
+        with mygobase_connect() as conn:
+            self.ppr = PPRIndex.open(conn)
 
     def fast_retrieve(self, query: str) -> Context:
-        similar_entities = self.graph.search_similar_entity(query, k=5, threshold=0.55)
-        context = Context()
-        for similar_entity in similar_entities:
-            contents = self.graph.search_entity(similar_entity)
-            if contents is None:
-                continue
-            for c in contents.contents:
-                context.add(c)
+        embedding = self.graph.embedder.extract_many([query])
+        context = Context(self.graph.load_scenes)
+        self.gather(context, [query], embedding, k=5, threshold=0.55)
         return context
 
-    def associate_retrieve(self, query: str) -> Context:
+    def gather(
+        self,
+        context: Context,
+        sources: List[str],
+        embeddings: np.ndarray,
+        k: int,
+        threshold: float,
+    ):
+        # One batched top-k for every probe, then merge the entities' scenes
+        # into context under the probe that reached them.
+        for source, ranked in zip(
+            sources, self.graph.rank_similar_embeddings(embeddings, k, threshold)
+        ):
+            for entity, score in ranked:
+                scene_ids = self.graph.search_entity(entity)
+                if scene_ids is None:
+                    continue
+                for scene_id in scene_ids:
+                    context.add(scene_id, score, source)
+
+    def expand(self, entities: Set[Entity], hops: int, budget: int) -> List[Entity]:
+        # Up to budget entities within hops of entities, best first: by the
+        # precomputed pagerank when there is one, else nearest first.
+        if hops <= 0 or budget <= 0:
+            return []
+        if self.ppr is not None:
+            return [entity for entity, _ in self.ppr.expand(entities, hops, budget)]
+        distances = self.graph.k_hop(entities, hops)
+        return sorted(
+            (entity for entity, hop in distances.items() if hop > 0),
+            key=lambda entity: (distances[entity], entity),
+        )[:budget]
+
+    def associate_retrieve(
+        self,
+        query: str,
+        max_edges: int = ASSOCIATE_EDGES,
+        hops: int = ASSOCIATE_HOPS,
+        budget: int = ASSOCIATE_BUDGET,
+    ) -> Context:
         entities = set()
+        unmatched = []
         for e in self.er_extractor.extract_entities(query).entities:
-            if e in self.graph.graph:
+            if self.graph.has_entity(e):
                 entities.add(e)
             else:
-                res = self.graph.search_similar_entity(e, k=1, threshold=0.8)
-                if res:
-                    entities.add(res[0])
-        associate_querys = []
-        for source, target, relation in self.graph.graph.subgraph(entities).edges(
-            data=True
+                unmatched.append(e)
+        # The query is embedded with the unmatched entities, it is a probe too.
+        embeddings = self.graph.embedder.extract_many(unmatched + [query])
+        for res in self.graph.search_similar_embeddings(
+            embeddings[:-1], k=1, threshold=0.8
         ):
-            associate_querys.append(f"{source} -> {relation['relation']} -> {target}")
-
-        context = Context()
-        for each_query in associate_querys + [query]:
-            for entity in self.graph.search_similar_entity(
-                each_query, k=5, threshold=0.55
-            ):
-                contents = self.graph.search_entity(entity)
-                if contents is None:
-                    continue
-                for c in contents.contents:
-                    context.add(c)
+            if res:
+                entities.add(res[0])
+        neighbourhood = entities | set(self.expand(entities, hops, budget))
+        # Only the best supported relations become probes, each embedded once
+        # whatever the number of scenes behind it; relations of the query's
+        # own entities come before those among their neighbours.
+        edges = sorted(
+            self.graph.edges_between(neighbourhood),
+            key=lambda edge: (
+                edge.source not in entities and edge.target not in entities,
+                -edge.weight,
+                edge.source,
+                edge.target,
+            ),
+        )[:max_edges]
+        associate_querys = [
+            f"{edge.source} -> {' / '.join(edge.relations)} -> {edge.target}"
+            for edge in edges
+        ]
+
+        context = Context(self.graph.load_scenes)
+        probe_embeddings = embeddings[-1:]
+        if associate_querys:
+            probe_embeddings = np.concatenate(
+                [self.graph.embedder.extract_many(associate_querys), probe_embeddings]
+            )
+        self.gather(
+            context, associate_querys + [query], probe_embeddings, k=5, threshold=0.55
+        )
         # print(context.generate_context())
         return context
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--backend",
+        type=GraphBackend,
+        choices=list(GraphBackend),
+        default=GraphBackend.SNAPSHOT,
+    )
+    args = parser.parse_args()
     query = "爽世为何同意愛音加入乐团？"
-    retriever = Retriever()
+    retriever = Retriever(backend=args.backend)
     retriever.associate_retrieve(query)
@@ -0,0 +1,100 @@
+import argparse
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+from typing import Callable, List
+
+import numpy as np
+
+from mygobase.bulk import BulkWriter, connect
+from mygobase.graph import knn
+
+# Query latency of the old full-scan search against vec0 KNN, on synthetic
+# entity tables of growing size.
+
+FULL_SCAN = """
+SELECT
+    entity,
+    1 - vec_distance_cosine(embedding, ?) as score
+FROM
+    entity_embedding
+ORDER BY
+    score DESC
+LIMIT
+    ?
+"""
+
+
+def full_scan(
+    conn: sqlite3.Connection, embedding: np.ndarray, k: int, threshold: float
+):
+    res = conn.execute(FULL_SCAN, (embedding.tobytes(), k)).fetchall()
+    return [(entity, score) for entity, score in res if score >= threshold]
+
+
+def populate(conn: sqlite3.Connection, n: int, dim: int, seed: int = 0):
+    conn.execute(
+        f"""
+        CREATE VIRTUAL TABLE entity_embedding USING vec0(
+            entity TEXT PRIMARY KEY,
+            embedding FLOAT[{dim}] distance_metric=cosine
+        )
+        """
+    )
+    rng = np.random.default_rng(seed)
+    chunk = 10_000
+    with BulkWriter(conn) as writer:
+        for start in range(0, n, chunk):
+            vectors = rng.standard_normal((min(chunk, n - start), dim), np.float32)
+            writer.extend(
+                "INSERT INTO entity_embedding (entity, embedding) VALUES (?, ?)",
+                (
+                    (f"entity-{start + i}", vector.tobytes())
+                    for i, vector in enumerate(vectors)
+                ),
+            )
+
+
+def latency(
+    search: Callable, conn: sqlite3.Connection, queries: np.ndarray, k: int
+) -> float:
+    times: List[float] = []
+    for query in queries:
+        start = time.perf_counter()
+        search(conn, query, k, 0.0)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1_000, 10_000, 100_000, 1_000_000],
+    )
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=20)
+    args = parser.parse_args()
+
+    queries = np.random.default_rng(1).standard_normal(
+        (args.queries, args.dim), np.float32
+    )
+    print(f"{'entities':>10} {'full scan ms':>13} {'knn ms':>8} {'same top-k':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in args.sizes:
+            conn = connect(os.path.join(tmp, f"{n}.db"))
+            populate(conn, n, args.dim)
+            same = all(
+                [e for e, _ in full_scan(conn, q, args.k, 0.0)]
+                == [e for e, _ in knn(conn, q, args.k, 0.0)]
+                for q in queries[:3]
+            )
+            scan_ms = latency(full_scan, conn, queries, args.k)
+            knn_ms = latency(knn, conn, queries, args.k)
+            print(f"{n:>10} {scan_ms:>13.2f} {knn_ms:>8.2f} {str(same):>11}")
+            conn.close()
@@ -0,0 +1,269 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from functools import cache
+from typing import Any, Dict, Optional, Type
+
+from openai import AsyncOpenAI, OpenAI
+from openai.types.chat import ChatCompletion
+from pydantic import BaseModel, ValidationError
+
+from mygobase import BASE_URL, LLM_CACHE_PATH
+
+TTL_SECONDS = 30 * 24 * 3600
+MAX_ENTRIES = 100_000
+# Expired and least recently used entries are dropped once per this many puts
+# (and on open) rather than on every put; get() never returns expired ones.
+EVICT_EVERY = 1_000
+# Only these arguments change what the model answers; stream/max_tokens do not.
+KEY_FIELDS = ("model", "messages", "temperature", "response_format")
+
+
+class ResponseCache:
+    # Chat completions keyed by a hash of the request, stored as the raw
+    # ChatCompletion JSON so callers validate cached and fresh answers the
+    # same way.
+    def __init__(
+        self,
+        path: str = LLM_CACHE_PATH,
+        ttl: float = TTL_SECONDS,
+        max_entries: int = MAX_ENTRIES,
+        evict_every: int = EVICT_EVERY,
+    ) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                digest BLOB PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_responses_created ON responses (created)"
+        )
+        with self.lock, self.conn:
+            self._evict(time.time())
+
+    @staticmethod
+    def key(request: Dict[str, Any]) -> bytes:
+        fields = {k: request.get(k) for k in KEY_FIELDS}
+        payload = json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode()).digest()
+
+    def get(self, request: Dict[str, Any]) -> Optional[ChatCompletion]:
+        digest = self.key(request)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response, created FROM responses WHERE digest = ?", (digest,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    with self.conn:
+                        self.conn.execute(
+                            "DELETE FROM responses WHERE digest = ?", (digest,)
+                        )
+                self.misses += 1
+                return None
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE responses SET accessed = ? WHERE digest = ?", (now, digest)
+                )
+            self.hits += 1
+        return ChatCompletion.model_validate_json(row[0])
+
+    def delete(self, request: Dict[str, Any]):
+        # Drops an entry get() just returned that turned out to be unusable;
+        # it no longer counts as a hit.
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM responses WHERE digest = ?", (self.key(request),)
+            )
+            self.hits -= 1
+            self.misses += 1
+
+    def put(self, request: Dict[str, Any], completion: ChatCompletion):
+        # Truncated or empty answers are not worth replaying.
+        choice = completion.choices[0]
+        if choice.finish_reason != "stop" or not choice.message.content:
+            return
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (digest, model, response, created, accessed) VALUES (?,?,?,?,?)",
+                (
+                    self.key(request),
+                    request.get("model"),
+                    completion.model_dump_json(),
+                    now,
+                    now,
+                ),
+            )
+            self.puts += 1
+            if self.puts % self.evict_every == 0:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        # Callers hold the lock and the transaction.
+        self.conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        self.conn.execute(
+            """
+            DELETE FROM responses
+            WHERE
+                digest IN (
+                    SELECT
+                        digest
+                    FROM
+                        responses
+                    ORDER BY
+                        accessed DESC
+                    LIMIT
+                        -1
+                    OFFSET
+                        ?
+                )
+            """,
+            (self.max_entries,),
+        )
+
+    def __str__(self) -> str:
+        return f"llm cache: {self.hits} hits, {self.misses} misses"
+
+
+@cache
+def shared_cache() -> ResponseCache:
+    return ResponseCache()
+
+
+def valid(
+    completion: ChatCompletion, response_model: Optional[Type[BaseModel]]
+) -> bool:
+    if response_model is None:
+        return True
+    try:
+        response_model.model_validate_json(completion.choices[0].message.content or "")
+    except ValidationError:
+        return False
+    return True
+
+
+class Usage:
+    # Tokens actually exchanged with the server; cache hits cost nothing.
+    def __init__(self) -> None:
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def count(self, completion: ChatCompletion):
+        self.requests += 1
+        if completion.usage is not None:
+            self.prompt_tokens += completion.usage.prompt_tokens
+            self.completion_tokens += completion.usage.completion_tokens
+
+    def __str__(self) -> str:
+        return (
+            f"{self.requests} requests, {self.prompt_tokens} prompt tokens, "
+            f"{self.completion_tokens} completion tokens"
+        )
+
+
+class CachedCompletions(Usage):
+    def __init__(self, client: OpenAI, response_cache: Optional[ResponseCache]):
+        super().__init__()
+        self.client = client
+        self.cache = response_cache
+
+    def create(
+        self, response_model: Optional[Type[BaseModel]] = None, **request
+    ) -> ChatCompletion:
+        # With response_model, only answers whose content validates against it
+        # are cached, so a malformed one is asked again instead of replayed.
+        completion = self.cache.get(request) if self.cache is not None else None
+        if completion is not None and not valid(completion, response_model):
+            self.cache.delete(request)  # type: ignore
+            completion = None
+        if completion is None:
+            completion = self.client.chat.completions.create(**request)
+            self.count(completion)
+            if self.cache is not None and valid(completion, response_model):
+                self.cache.put(request, completion)
+        return completion
+
+
+class CachedChat:
+    def __init__(self, completions: CachedCompletions):
+        self.completions = completions
+
+
+class CachedOpenAI:
+    # Drop-in for the OpenAI client as far as chat.completions.create goes;
+    # bypass=True talks to the server directly and leaves the cache untouched.
+    def __init__(
+        self,
+        base_url: str = BASE_URL,
+        bypass: bool = False,
+        response_cache: Optional[ResponseCache] = None,
+    ) -> None:
+        self.client = OpenAI(base_url=base_url, api_key="lm-studio")
+        if not bypass and response_cache is None:
+            response_cache = shared_cache()
+        self.cache = None if bypass else response_cache
+        self.chat = CachedChat(CachedCompletions(self.client, self.cache))
+
+
+class AsyncCachedCompletions(Usage):
+    def __init__(self, client: AsyncOpenAI, response_cache: Optional[ResponseCache]):
+        super().__init__()
+        self.client = client
+        self.cache = response_cache
+
+    async def create(
+        self, response_model: Optional[Type[BaseModel]] = None, **request
+    ) -> ChatCompletion:
+        # Cache lookups are local SQLite reads, cheap enough to run on the loop.
+        completion = self.cache.get(request) if self.cache is not None else None
+        if completion is not None and not valid(completion, response_model):
+            self.cache.delete(request)  # type: ignore
+            completion = None
+        if completion is None:
+            completion = await self.client.chat.completions.create(**request)
+            self.count(completion)
+            if self.cache is not None and valid(completion, response_model):
+                self.cache.put(request, completion)
+        return completion
+
+
+class AsyncCachedChat:
+    def __init__(self, completions: AsyncCachedCompletions):
+        self.completions = completions
+
+
+class AsyncCachedOpenAI:
+    def __init__(
+        self,
+        base_url: str = BASE_URL,
+        bypass: bool = False,
+        response_cache: Optional[ResponseCache] = None,
+    ) -> None:
+        self.client = AsyncOpenAI(base_url=base_url, api_key="lm-studio")
+        if not bypass and response_cache is None:
+            response_cache = shared_cache()
+        self.cache = None if bypass else response_cache
+        self.chat = AsyncCachedChat(AsyncCachedCompletions(self.client, self.cache))
@@ -1,17 +1,184 @@
-from typing import List
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 from openai import OpenAI
 
-from mygobase import BASE_URL, EMBEDD_MODEL
+from mygobase import BASE_URL, EMBEDD_MODEL, EMBEDDING_CACHE_PATH
+
+# Largest request the embedding endpoint accepts, counted in inputs and in
+# characters over all inputs.
+MAX_BATCH_SIZE = 64
+MAX_BATCH_CHARS = 16384
+MAX_CONCURRENCY = 4
+# In-process budget for cached vectors, in bytes.
+LRU_BYTES = 64 * 1024 * 1024
+
+
+def pack(
+    texts: List[str],
+    max_size: int = MAX_BATCH_SIZE,
+    max_chars: int = MAX_BATCH_CHARS,
+) -> List[List[int]]:
+    # Greedily groups input positions into batches within both limits; a text
+    # longer than max_chars still gets a batch of its own.
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    chars = 0
+    for i, text in enumerate(texts):
+        if batch and (len(batch) >= max_size or chars + len(text) > max_chars):
+            batches.append(batch)
+            batch, chars = [], 0
+        batch.append(i)
+        chars += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+type CacheKey = Tuple[str, bytes]
+
+
+class EmbeddingCache:
+    # Embeddings keyed by (model, sha256 of the text), kept as float32 blobs in
+    # SQLite with an LRU in front. The model is part of the key, so switching
+    # EMBEDD_MODEL never serves vectors from another model.
+    def __init__(
+        self,
+        path: str = EMBEDDING_CACHE_PATH,
+        model: str = EMBEDD_MODEL,
+        max_bytes: int = LRU_BYTES,
+    ) -> None:
+        self.model = model
+        self.max_bytes = max_bytes
+        self.lru: OrderedDict[CacheKey, np.ndarray] = OrderedDict()
+        self.lru_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                digest BLOB NOT NULL,
+                embedding BLOB NOT NULL,
+                PRIMARY KEY (model, digest)
+            ) WITHOUT ROWID
+            """
+        )
+
+    def key(self, text: str) -> CacheKey:
+        return (self.model, hashlib.sha256(text.encode()).digest())
+
+    def _remember(self, key: CacheKey, embedding: np.ndarray):
+        if key in self.lru:
+            self.lru.move_to_end(key)
+            return
+        self.lru[key] = embedding
+        self.lru_bytes += embedding.nbytes
+        while self.lru_bytes > self.max_bytes and self.lru:
+            _, evicted = self.lru.popitem(last=False)
+            self.lru_bytes -= evicted.nbytes
+
+    def get_many(self, texts: List[str]) -> Dict[int, np.ndarray]:
+        # Returns the cached vectors by input position.
+        found: Dict[int, np.ndarray] = {}
+        missing: Dict[bytes, List[int]] = {}
+        with self.lock:
+            for i, text in enumerate(texts):
+                key = self.key(text)
+                if key in self.lru:
+                    self.lru.move_to_end(key)
+                    found[i] = self.lru[key]
+                    self.hits += 1
+                else:
+                    missing.setdefault(key[1], []).append(i)
+            digests = list(missing)
+            for start in range(0, len(digests), 500):
+                chunk = digests[start : start + 500]
+                for digest, blob in self.conn.execute(
+                    f"SELECT digest, embedding FROM embeddings WHERE model = ? AND digest IN ({','.join('?' * len(chunk))})",
+                    [self.model, *chunk],
+                ):
+                    embedding = np.frombuffer(blob, dtype=np.float32)
+                    self._remember((self.model, digest), embedding)
+                    for i in missing.pop(digest):
+                        found[i] = embedding
+                        self.disk_hits += 1
+            self.misses += sum(len(positions) for positions in missing.values())
+        return found
+
+    def put_many(self, texts: List[str], embeddings: np.ndarray):
+        with self.lock:
+            rows = []
+            for text, embedding in zip(texts, embeddings):
+                key = self.key(text)
+                self._remember(key, embedding)
+                rows.append((key[0], key[1], embedding.tobytes()))
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, digest, embedding) VALUES (?,?,?)",
+                    rows,
+                )
+
+    def __str__(self) -> str:
+        total = self.hits + self.disk_hits + self.misses
+        return (
+            f"embedding cache: {self.hits} memory hits, {self.disk_hits} disk hits, "
+            f"{self.misses} misses of {total}, {len(self.lru)} vectors in memory"
+        )
+
+
+@cache
+def shared_embedding_cache() -> EmbeddingCache:
+    return EmbeddingCache()
 
 
 class EmbeddingExtractor:
-    def __init__(self) -> None:
+    def __init__(self, embedding_cache: Optional[EmbeddingCache] = None) -> None:
         self.client = OpenAI(base_url=BASE_URL, api_key="lm-studio")
+        self.cache = (
+            embedding_cache if embedding_cache is not None else shared_embedding_cache()
+        )
 
     def extract(self, text: str) -> List[float]:
+        return self.extract_many([text])[0].tolist()
+
+    def _extract_batch(self, texts: List[str]) -> np.ndarray:
         resp = self.client.embeddings.create(
-            input=text, model=EMBEDD_MODEL, encoding_format="float"
+            input=texts, model=EMBEDD_MODEL, encoding_format="float"
         )
-        embedding = resp.data[0].embedding
-        return embedding
+        data = sorted(resp.data, key=lambda d: d.index)
+        return np.asarray([d.embedding for d in data], dtype=np.float32)
+
+    def extract_many(
+        self, texts: List[str], concurrency: int = MAX_CONCURRENCY
+    ) -> np.ndarray:
+        # Returns a (len(texts), dim) float32 matrix in input order.
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        found = self.cache.get_many(texts)
+        misses = list(dict.fromkeys(t for i, t in enumerate(texts) if i not in found))
+        if misses:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(
+                    executor.map(
+                        lambda batch: self._extract_batch([misses[i] for i in batch]),
+                        pack(misses),
+                    )
+                )
+            embeddings = np.concatenate(results)
+            self.cache.put_many(misses, embeddings)
+            fetched = dict(zip(misses, embeddings))
+            for i, text in enumerate(texts):
+                if i not in found:
+                    found[i] = fetched[text]
+        return np.stack([found[i] for i in range(len(texts))])
@@ -1,12 +1,12 @@
-from typing import List
+from typing import Any, Dict, List, Tuple
 
-from openai import OpenAI
 from openai.types.chat import ChatCompletion
 from openai.types.shared_params import ResponseFormatJSONSchema
 from openai.types.shared_params.response_format_json_schema import JSONSchema
 from pydantic import BaseModel
 
-from mygobase import BASE_URL, CHAT_MODEL
+from mygobase import CHAT_MODEL
+from mygobase.llmtools.cache import AsyncCachedOpenAI, CachedOpenAI
 
 ENTITY_EXTRACTION_PROMPT = """
 我想要构建知识图谱，请从给定的文本中提取核心实体，遵循以下指南：
@@ -55,6 +55,37 @@ RELATION_EXTRACTION_PROMPT = """
 请分析给定的文本，并直接输出json，无需额外的解释说明。
 """
 
+JOINT_EXTRACTION_PROMPT = """
+我想要构建知识图谱，请从给定的文本中同时提取核心实体以及这些实体之间的关系，遵循以下指南：
+- 只选择最核心、出现频率最高的2到4个实体
+- 请严格判断，如果找到的实体不能反映所有评论整体反映的主题，或者评论是明显无意义的重复评论，无需提取实体，entities请返回空列表
+- 将简写的实体名补充为完整形式
+- 提取的实体需要和话题或评论整体反映的主题紧密相关。请提取具体的、有实际意义的实体，避免空泛的概念，实体应该是独立的名词形式
+- 关系的source和target都必须是entities中的实体
+- 每个关系应该反映的是评论的某种观点，包含这组实体之间完整的上下文、逻辑联系和背景信息，避免提取孤立的、缺乏意义的关系
+- 一组实体间只能有一个关系。请严格判断，不是所有的实体都需要有联系，如果没有找到有效关系，relations请返回空列表
+- 实体和关系字串去掉前后空格
+- 中文回答实体与关系名称
+
+输出格式：
+   以 JSON 格式输出结果，结构如下：
+   ```json
+   {
+     "entities": ["实体1", "实体2"...],
+     "relations": [
+       {
+         "source": "实体1",
+         "target": "实体2",
+         "relation": "关系描述"
+       },
+       // 更多关系...
+     ]
+   }
+   ```
+
+请分析给定的文本，并直接输出json，无需额外的解释说明。
+"""
+
 
 class Relation(BaseModel):
     source: str
@@ -73,62 +104,157 @@ class Entities(BaseModel):
     entities: List[Entity]
 
 
+class EntitiesRelations(BaseModel):
+    entities: List[Entity]
+    relations: List[Relation]
+
+
+def entities_request(text: str, temperature: float) -> Dict[str, Any]:
+    return dict(
+        messages=[
+            {
+                "role": "system",
+                "content": ENTITY_EXTRACTION_PROMPT,
+            },
+            {
+                "role": "user",
+                "content": f"请从以下文本中提取与话题相关的核心实体：\n\n{text}",
+            },
+        ],
+        model=CHAT_MODEL,
+        stream=False,
+        max_tokens=-1,
+        temperature=temperature,
+        response_format=ResponseFormatJSONSchema(
+            json_schema=JSONSchema(
+                name="Entities", schema=Entities.model_json_schema()
+            ),
+            type="json_schema",
+        ),
+    )
+
+
+def relations_request(
+    text: str, entities: List[str], temperature: float
+) -> Dict[str, Any]:
+    entities_str = ", ".join(entities)
+    return dict(
+        messages=[
+            {
+                "role": "system",
+                "content": RELATION_EXTRACTION_PROMPT,
+            },
+            {
+                "role": "user",
+                "content": f"已知实体列表：{entities_str}\n\n请从以下文本中提取这些实体之间的关系：\n\n{text}",
+            },
+        ],
+        model=CHAT_MODEL,
+        stream=False,
+        max_tokens=-1,
+        temperature=temperature,
+        response_format=ResponseFormatJSONSchema(
+            json_schema=JSONSchema(
+                name="Relations", schema=Relations.model_json_schema()
+            ),
+            type="json_schema",
+        ),
+    )
+
+
+def joint_request(text: str, temperature: float) -> Dict[str, Any]:
+    return dict(
+        messages=[
+            {
+                "role": "system",
+                "content": JOINT_EXTRACTION_PROMPT,
+            },
+            {
+                "role": "user",
+                "content": f"请从以下文本中提取核心实体及其之间的关系：\n\n{text}",
+            },
+        ],
+        model=CHAT_MODEL,
+        stream=False,
+        max_tokens=-1,
+        temperature=temperature,
+        response_format=ResponseFormatJSONSchema(
+            json_schema=JSONSchema(
+                name="EntitiesRelations", schema=EntitiesRelations.model_json_schema()
+            ),
+            type="json_schema",
+        ),
+    )
+
+
+def split_joint(result: EntitiesRelations) -> Tuple[Entities, Relations]:
+    # Same contract as the two-call mode: relations only between the entities.
+    names = set(result.entities)
+    return Entities(entities=result.entities), Relations(
+        relations=[
+            r for r in result.relations if r.source in names and r.target in names
+        ]
+    )
+
+
 class EntityRelationExtractor:
-    def __init__(self) -> None:
-        self.client = OpenAI(base_url=BASE_URL, api_key="lm-studio")
+    def __init__(self, bypass_cache: bool = False) -> None:
+        self.client = CachedOpenAI(bypass=bypass_cache)
         self.temperature = 0.3
 
     def extract_entities(self, text: str) -> Entities:
         chat_completion: ChatCompletion = self.client.chat.completions.create(
-            messages=[
-                {
-                    "role": "system",
-                    "content": ENTITY_EXTRACTION_PROMPT,
-                },
-                {
-                    "role": "user",
-                    "content": f"请从以下文本中提取与话题相关的核心实体：\n\n{text}",
-                },
-            ],
-            model=CHAT_MODEL,
-            stream=False,
-            max_tokens=-1,
-            temperature=self.temperature,
-            response_format=ResponseFormatJSONSchema(
-                json_schema=JSONSchema(
-                    name="Entities", schema=Entities.model_json_schema()
-                ),
-                type="json_schema",
-            ),
+            response_model=Entities, **entities_request(text, self.temperature)
         )
 
         content: str = chat_completion.choices[0].message.content  # type: ignore
         return Entities.model_validate_json(content)
 
     def extract_relations(self, text: str, entities: List[str]) -> Relations:
-        entities_str = ", ".join(entities)
         chat_completion: ChatCompletion = self.client.chat.completions.create(
-            messages=[
-                {
-                    "role": "system",
-                    "content": RELATION_EXTRACTION_PROMPT,
-                },
-                {
-                    "role": "user",
-                    "content": f"已知实体列表：{entities_str}\n\n请从以下文本中提取这些实体之间的关系：\n\n{text}",
-                },
-            ],  # type: ignore
-            model=CHAT_MODEL,
-            stream=False,
-            max_tokens=-1,
-            temperature=self.temperature,
-            response_format=ResponseFormatJSONSchema(
-                json_schema=JSONSchema(
-                    name="Relations", schema=Relations.model_json_schema()
-                ),
-                type="json_schema",
-            ),
+            response_model=Relations,
+            **relations_request(text, entities, self.temperature),
+        )
+
+        content: str = chat_completion.choices[0].message.content  # type: ignore
+        return Relations.model_validate_json(content)
+
+    def extract(self, text: str) -> Tuple[Entities, Relations]:
+        # One round-trip for both, instead of extract_entities + extract_relations.
+        chat_completion: ChatCompletion = self.client.chat.completions.create(
+            response_model=EntitiesRelations, **joint_request(text, self.temperature)
+        )
+
+        content: str = chat_completion.choices[0].message.content  # type: ignore
+        return split_joint(EntitiesRelations.model_validate_json(content))
+
+
+class AsyncEntityRelationExtractor:
+    def __init__(self, bypass_cache: bool = False) -> None:
+        self.client = AsyncCachedOpenAI(bypass=bypass_cache)
+        self.temperature = 0.3
+
+    async def extract_entities(self, text: str) -> Entities:
+        chat_completion: ChatCompletion = await self.client.chat.completions.create(
+            response_model=Entities, **entities_request(text, self.temperature)
+        )
+
+        content: str = chat_completion.choices[0].message.content  # type: ignore
+        return Entities.model_validate_json(content)
+
+    async def extract_relations(self, text: str, entities: List[str]) -> Relations:
+        chat_completion: ChatCompletion = await self.client.chat.completions.create(
+            response_model=Relations,
+            **relations_request(text, entities, self.temperature),
         )
 
         content: str = chat_completion.choices[0].message.content  # type: ignore
         return Relations.model_validate_json(content)
+
+    async def extract(self, text: str) -> Tuple[Entities, Relations]:
+        chat_completion: ChatCompletion = await self.client.chat.completions.create(
+            response_model=EntitiesRelations, **joint_request(text, self.temperature)
+        )
+
+        content: str = chat_completion.choices[0].message.content  # type: ignore
+        return split_joint(EntitiesRelations.model_validate_json(content))
@@ -1,12 +1,12 @@
 from enum import Enum
 
-from openai import OpenAI
 from openai.types.chat import ChatCompletion
 from openai.types.shared_params import ResponseFormatJSONSchema
 from openai.types.shared_params.response_format_json_schema import JSONSchema
 from pydantic import BaseModel
 
-from mygobase import BASE_URL, CHAT_MODEL
+from mygobase import CHAT_MODEL
+from mygobase.llmtools.cache import CachedOpenAI
 
 PROMPT = """
 你是動畫台詞劇本分析專家。
@@ -43,12 +43,13 @@ class Strategy(BaseModel):
 
 
 class StrategyPicker:
-    def __init__(self) -> None:
-        self.client = OpenAI(base_url=BASE_URL, api_key="lm-studio")
+    def __init__(self, bypass_cache: bool = False) -> None:
+        self.client = CachedOpenAI(bypass=bypass_cache)
         self.temperature = 0.3
 
     def pick(self, text: str) -> Strategy:
         chat_completion: ChatCompletion = self.client.chat.completions.create(
+            response_model=Strategy,
             messages=[
                 {
                     "role": "system",
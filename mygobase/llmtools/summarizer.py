@@ -1,12 +1,12 @@
 from typing import List
 
-from openai import OpenAI
 from openai.types.chat import ChatCompletion
 from openai.types.shared_params import ResponseFormatJSONSchema
 from openai.types.shared_params.response_format_json_schema import JSONSchema
 from pydantic import BaseModel
 
-from mygobase import BASE_URL, CHAT_MODEL
+from mygobase import CHAT_MODEL
+from mygobase.llmtools.cache import CachedOpenAI
 
 
 class Finding(BaseModel):
@@ -110,11 +110,12 @@ Output:"""
 
 
 class CommunityReporter:
-    def __init__(self) -> None:
-        self.client = OpenAI(base_url=BASE_URL, api_key="lm-studio")
+    def __init__(self, bypass_cache: bool = False) -> None:
+        self.client = CachedOpenAI(bypass=bypass_cache)
 
     def extract(self, text: str):
         chat_completion: ChatCompletion = self.client.chat.completions.create(
+            response_model=Report,
             messages=[
                 {
                     "role": "system",
@@ -138,11 +139,12 @@ class KeyPoint(BaseModel):
 
 
 class Summarizer:
-    def __init__(self) -> None:
-        self.client = OpenAI(base_url=BASE_URL, api_key="lm-studio")
+    def __init__(self, bypass_cache: bool = False) -> None:
+        self.client = CachedOpenAI(bypass=bypass_cache)
 
     def summarize(self, query, context: str) -> KeyPoint:
         chat_completion: ChatCompletion = self.client.chat.completions.create(
+            response_model=KeyPoint,
             messages=[
                 {
                     "role": "system",
@@ -186,8 +188,8 @@ class Summarizer:
 
 
 class Questioner:
-    def __init__(self) -> None:
-        self.client = OpenAI(base_url=BASE_URL, api_key="lm-studio")
+    def __init__(self, bypass_cache: bool = False) -> None:
+        self.client = CachedOpenAI(bypass=bypass_cache)
 
     def transform(self, query) -> str:
         chat_completion: ChatCompletion = self.client.chat.completions.create(
@@ -220,11 +222,14 @@ filter_json_schema = ResponseFormatJSONSchema(
 
 
 class Filter:
-    def __init__(self) -> None:
-        self.client = OpenAI(base_url="http://127.0.0.1:1234/v1", api_key="lm-studio")
+    def __init__(self, bypass_cache: bool = False) -> None:
+        self.client = CachedOpenAI(
+            base_url="http://127.0.0.1:1234/v1", bypass=bypass_cache
+        )
 
     def filter(self, query: str, text: str) -> bool:
         chat_completion: ChatCompletion = self.client.chat.completions.create(
+            response_model=Useful,
             messages=[
                 {
                     "role": "system",
@@ -1,61 +1,41 @@
+import argparse
+import asyncio
+import hashlib
+import json
 import sqlite3
+import time
 from collections import defaultdict
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
 
-import polars as pl
-import sqlite_vec
 from pydantic import BaseModel, ConfigDict
-from sqlite_vec import serialize_float32
 from tqdm import tqdm
 
-from mygobase import DB_PATH
+from mygobase import DB_PATH, snapshot, sqlgraph, versions
+from mygobase.bulk import BulkWriter, connect
+from mygobase.entity_index import EntityIndex
 from mygobase.llmtools.embedding import EmbeddingExtractor
-from mygobase.llmtools.er import Entity, EntityRelationExtractor, Relations
+from mygobase.llmtools.er import (
+    AsyncEntityRelationExtractor,
+    Entity,
+    Relations,
+)
+from mygobase.ppr import PPRIndex
+from mygobase.script import load_df, load_scenes
 
-
-def load_df():
-    with sqlite3.connect("db/mygo.db") as conn:
-        df = pl.read_database(
-            """
-                SELECT
-                    id,
-                    scene,
-                    frame_number,
-                    role,
-                    subtitle
-                FROM
-                    storyboards
-                ORDER BY
-                    scene,
-                    frame_number
-                """,
-            connection=conn,
-        )
-        return df
-
-
-def load_scenes(df: pl.DataFrame) -> List[tuple[int, str]]:
-    scene_docs: List[tuple[int, str]] = []
-    for (scene_id,), scene_db in df.group_by("scene", maintain_order=True):
-        script = ""
-        for role, subtitle in scene_db.select(["role", "subtitle"]).iter_rows():
-            script += f"{role.strip()}:{subtitle.strip()}\n"
-        scene_docs.append((scene_id, script))  # type: ignore
-    print("load scenes completed")
-    return scene_docs
+# Requests in flight at once; match it to the number of parallel sequences the
+# LLM server is configured for.
+NER_CONCURRENCY = 4
+NER_RETRIES = 2
 
 
 class Content(BaseModel):
+    scene: int
     title: str
     content: str
 
     model_config = ConfigDict(frozen=True)
 
 
-class Contents(BaseModel):
-    contents: List[Content]
-
-
 replace_table = {
     "高松燈": "燈",
     "小灯": "燈",
@@ -99,80 +79,340 @@ def replace(entity: Entity) -> Entity:
     return entity
 
 
+class SceneResult(NamedTuple):
+    scene_id: int
+    entities: List[Entity]
+    relations: Relations
+
+
+class SceneFailure(NamedTuple):
+    scene_id: int
+    error: str
+
+
+def script_digest(script: str) -> str:
+    return hashlib.sha256(script.encode()).hexdigest()
+
+
+def normalize(result: SceneResult) -> SceneResult:
+    relations = result.relations.model_copy(deep=True)
+    for relation in relations.relations:
+        relation.source = replace(relation.source)
+        relation.target = replace(relation.target)
+    return SceneResult(result.scene_id, list(map(replace, result.entities)), relations)
+
+
+def load_checkpoints(
+    conn: sqlite3.Connection,
+) -> Dict[int, Tuple[Optional[str], Optional[List[Entity]]]]:
+    # scene -> (script digest, entities) of the last stored extraction. Rows
+    # written before checkpointing have neither and are always recomputed.
+    return {
+        scene_id: (digest, json.loads(entities) if entities is not None else None)
+        for scene_id, digest, entities in conn.execute(
+            "SELECT scene, digest, entities FROM ner"
+        )
+    }
+
+
+def mark_dirty(conn: sqlite3.Connection, entities: Iterable[Entity]):
+    # Entities whose contents must be rebuilt. Kept in the database so a run
+    # that dies before update_entities still gets them rebuilt by the next one.
+    conn.executemany(
+        "INSERT OR IGNORE INTO entity_dirty (entity) VALUES (?)",
+        [(entity,) for entity in entities],
+    )
+
+
+def scene_title(entities: List[Entity]) -> str:
+    return ", ".join(entities)
+
+
+def save_scripts(conn: sqlite3.Connection, rows: Iterable[Tuple[int, str, str]]):
+    # (scene, title, script): every script is stored once, entities only
+    # keep the ids of the scenes they appear in.
+    conn.executemany(
+        """
+        INSERT INTO scenes (id, title, script)
+        VALUES (?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+            title = excluded.title,
+            script = excluded.script
+        WHERE
+            title != excluded.title
+            OR script != excluded.script
+        """,
+        rows,
+    )
+
+
+def save_scene(
+    conn: sqlite3.Connection,
+    result: SceneResult,
+    digest: str,
+    script: str,
+    previous: Optional[List[Entity]],
+):
+    with conn:
+        mark_dirty(conn, [*(previous or []), *result.entities])
+        save_scripts(conn, [(result.scene_id, scene_title(result.entities), script)])
+        conn.execute(
+            """
+            INSERT INTO ner (scene, ner, digest, entities)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (scene) DO UPDATE SET
+                ner = excluded.ner,
+                digest = excluded.digest,
+                entities = excluded.entities
+            """,
+            (
+                result.scene_id,
+                result.relations.model_dump_json(),
+                digest,
+                json.dumps(result.entities, ensure_ascii=False),
+            ),
+        )
+        versions.bump(conn, versions.GRAPH)
+
+
+def update_entities(conn: sqlite3.Connection, embedder: EmbeddingExtractor):
+    # Rebuild the scene lists of the dirty entities from the stored scenes,
+    # drop the ones no scene mentions anymore and embed the ones that are new.
+    affected: Set[Entity] = {
+        entity for (entity,) in conn.execute("SELECT entity FROM entity_dirty")
+    }
+    contents: Dict[Entity, List[int]] = defaultdict(list)
+    for scene_id, entities_json in conn.execute(
+        """
+        SELECT
+            ner.scene,
+            ner.entities
+        FROM
+            ner
+            JOIN scenes ON scenes.id = ner.scene
+        WHERE
+            ner.entities IS NOT NULL
+        ORDER BY
+            ner.scene
+        """
+    ):
+        entities: List[Entity] = json.loads(entities_json)
+        for entity in entities:
+            if entity in affected:
+                contents[entity].append(scene_id)
+
+    embedded = {
+        entity for (entity,) in conn.execute("SELECT entity FROM entity_embedding")
+    }
+    new_entities = [entity for entity in contents if entity not in embedded]
+    embeddings = embedder.extract_many(new_entities)
+    print(embedder.cache)
+
+    # Every statement is idempotent, so a crash between flushes is repaired by
+    # rerunning; the dirty marks are only cleared once everything is written.
+    removed = affected - contents.keys()
+    with conn:
+        # Before any row changes, so a run that dies halfway leaves the
+        # derived data stale rather than current.
+        if contents or removed:
+            versions.bump(conn, versions.GRAPH)
+        if new_entities or removed:
+            versions.bump(conn, versions.EMBEDDING)
+    with BulkWriter(conn) as writer:
+        writer.extend(
+            "DELETE FROM entity WHERE entity = ?", [(entity,) for entity in removed]
+        )
+        writer.extend(
+            "DELETE FROM entity_embedding WHERE entity = ?",
+            [(entity,) for entity in removed],
+        )
+        writer.extend(
+            "INSERT INTO entity_embedding (entity, embedding) VALUES (?, ?)",
+            (
+                (entity, embedding.tobytes())
+                for entity, embedding in zip(new_entities, embeddings)
+            ),
+        )
+        writer.extend(
+            "INSERT OR REPLACE INTO entity (entity, scenes) VALUES (?, ?)",
+            ((entity, json.dumps(scene_ids)) for entity, scene_ids in contents.items()),
+        )
+    with conn:
+        conn.executemany(
+            "DELETE FROM entity_dirty WHERE entity = ?",
+            [(entity,) for entity in affected],
+        )
+    print(
+        f"{len(contents)} entities updated, {len(new_entities)} new, "
+        f"{len(removed)} removed"
+    )
+
+
+async def extract_scene(
+    extractor: AsyncEntityRelationExtractor,
+    semaphore: asyncio.Semaphore,
+    scene_id: int,
+    script: str,
+    retries: int,
+    joint: bool = False,
+) -> SceneResult | SceneFailure:
+    # In two-call mode relations are asked for only once the scene's entities
+    # are known; other scenes run meanwhile.
+    error: Exception | None = None
+    async with semaphore:
+        for attempt in range(retries + 1):
+            try:
+                if joint:
+                    found, relations = await extractor.extract(script)
+                    entities = found.entities
+                else:
+                    entities = (await extractor.extract_entities(script)).entities
+                    relations = await extractor.extract_relations(script, entities)
+                return SceneResult(scene_id, entities, relations)
+            except Exception as e:
+                error = e
+                if attempt < retries:
+                    await asyncio.sleep(2**attempt)
+    return SceneFailure(scene_id, repr(error))
+
+
+async def extract_scenes(
+    extractor: AsyncEntityRelationExtractor,
+    scenes: List[tuple[int, str]],
+    concurrency: int = NER_CONCURRENCY,
+    retries: int = NER_RETRIES,
+    joint: bool = False,
+    on_result: Optional[Callable[[SceneResult | SceneFailure], None]] = None,
+) -> List[SceneResult | SceneFailure]:
+    # Results come back in the order of scenes, whatever order they finish in;
+    # on_result sees each one as soon as it is done.
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [
+        asyncio.create_task(
+            extract_scene(extractor, semaphore, scene_id, script, retries, joint)
+        )
+        for scene_id, script in scenes
+    ]
+    start = time.perf_counter()
+    with tqdm(total=len(tasks), desc="extracting entity and relation") as bar:
+        for task in asyncio.as_completed(tasks):
+            result = await task
+            if on_result is not None:
+                on_result(result)
+            bar.update()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{len(tasks)} scenes in {elapsed:.1f}s "
+        f"({len(tasks) / max(elapsed, 1e-9) * 60:.1f} scenes/min)"
+    )
+    print(extractor.client.chat.completions)
+    if extractor.client.cache is not None:
+        print(extractor.client.cache)
+    return [task.result() for task in tasks]
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always ask the LLM, ignore cached answers",
+    )
+    parser.add_argument("--concurrency", type=int, default=NER_CONCURRENCY)
+    parser.add_argument("--retries", type=int, default=NER_RETRIES)
+    parser.add_argument(
+        "--joint",
+        action="store_true",
+        help="extract entities and relations in one request per scene",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="re-extract scenes that are up to date"
+    )
+    args = parser.parse_args()
+
     scenes = load_scenes(load_df())
+    scripts = dict(scenes)
+    digests = {scene_id: script_digest(script) for scene_id, script in scenes}
 
-    er_extractor = EntityRelationExtractor()
-    all_entities: Dict[Entity, List[Content]] = defaultdict(list)
-    all_ners: Dict[int, Tuple[List[Entity], Relations]] = {}
-    for scene_id, script in tqdm(scenes, desc="extracting entity and relation"):
-        try:
-            entities = er_extractor.extract_entities(script).entities
-            relations = er_extractor.extract_relations(script, entities)
-
-            entities = list(map(replace, entities))
-            for relation in relations.relations:
-                relation.source = replace(relation.source)
-                relation.target = replace(relation.target)
-
-            content = Content(title=", ".join(entities), content=script)
-            for entity in entities:
-                all_entities[entity].append(content)
-            all_ners[scene_id] = (entities, relations)
-        except Exception as e:
-            print(e)
-
-    embeddings: Dict[Entity, List[float]] = {}
-    embedd_extractor = EmbeddingExtractor()
-    for entity in all_entities.keys():
-        try:
-            embeddings[entity] = embedd_extractor.extract(entity)
-        except Exception as e:
-            print(e)
-
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.enable_load_extension(True)
-        sqlite_vec.load(conn)
-        conn.enable_load_extension(False)
-
-        conn.execute("DELETE FROM entity_embedding")
-        conn.execute("DELETE FROM entity")
-        conn.execute("DELETE FROM ner")
-        conn.commit()
-
-        for entity, contents in tqdm(
-            all_entities.items(), desc="inserting entity embeddings"
-        ):
-            contents = Contents(contents=contents)
-
-            conn.execute(
-                """
-                INSERT INTO entity_embedding (entity, embedding)
-                VALUES (?, ?)
-            """,
-                (
-                    entity,
-                    serialize_float32(embeddings[entity]),
-                ),
+    with connect(DB_PATH) as conn:
+        checkpoints = load_checkpoints(conn)
+        pending = [
+            (scene_id, script)
+            for scene_id, script in scenes
+            if args.force
+            or checkpoints.get(scene_id, (None, None))[0] != digests[scene_id]
+        ]
+        removed = checkpoints.keys() - digests.keys()
+        print(
+            f"{len(scenes) - len(pending)} scenes up to date, "
+            f"{len(pending)} to extract, {len(removed)} removed"
+        )
+
+        with conn:
+            if any(entities is None for _, entities in checkpoints.values()):
+                # Rows written before checkpointing do not say what they held.
+                mark_dirty(
+                    conn,
+                    [entity for (entity,) in conn.execute("SELECT entity FROM entity")],
+                )
+            for scene_id in removed:
+                mark_dirty(conn, checkpoints[scene_id][1] or [])
+            changes = conn.total_changes
+            conn.executemany(
+                "DELETE FROM ner WHERE scene = ?", [(scene_id,) for scene_id in removed]
             )
-            conn.execute(
-                """
-                INSERT INTO entity (entity, content)
-                VALUES (?, ?)
-            """,
-                (
-                    entity,
-                    contents.model_dump_json(),
-                ),
+            conn.executemany(
+                "DELETE FROM scenes WHERE id = ?", [(scene_id,) for scene_id in removed]
+            )
+            # Scenes extracted before scripts had their own table.
+            save_scripts(
+                conn,
+                [
+                    (scene_id, scene_title(entities), script)
+                    for scene_id, script in scenes
+                    if scene_id in checkpoints
+                    and (entities := checkpoints[scene_id][1]) is not None
+                    and checkpoints[scene_id][0] == digests[scene_id]
+                ],
+            )
+            if conn.total_changes != changes:
+                versions.bump(conn, versions.GRAPH)
+
+        failures: List[SceneFailure] = []
+
+        def checkpoint(result: SceneResult | SceneFailure):
+            if isinstance(result, SceneFailure):
+                failures.append(result)
+                return
+            result = normalize(result)
+            previous = checkpoints.get(result.scene_id, (None, None))[1]
+            save_scene(
+                conn,
+                result,
+                digests[result.scene_id],
+                scripts[result.scene_id],
+                previous,
             )
 
-        for scene_id, (_, relations) in tqdm(
-            all_ners.items(), desc="inserting relations"
-        ):
-            conn.execute(
-                """
-                INSERT INTO ner (scene, ner)
-                VALUES (?, ?)
-                """,
-                (scene_id, relations.model_dump_json()),
+        extractor = AsyncEntityRelationExtractor(bypass_cache=args.no_cache)
+        asyncio.run(
+            extract_scenes(
+                extractor,
+                pending,
+                args.concurrency,
+                args.retries,
+                args.joint,
+                on_result=checkpoint,
             )
+        )
+        if failures:
+            # Their old rows (if any) stay, so the next run picks them up again.
+            print(f"{len(failures)} scenes failed:")
+            for failure in failures:
+                print(f"  scene {failure.scene_id}: {failure.error}")
+
+        update_entities(conn, EmbeddingExtractor())
+        EntityIndex.build(conn)
+        snapshot.write(conn)
+        sqlgraph.write(conn)
+        PPRIndex.build(conn)
@@ -0,0 +1,79 @@
+import argparse
+import asyncio
+import time
+from typing import Dict, List, Set, Tuple
+
+from mygobase.llmtools.er import AsyncEntityRelationExtractor
+from mygobase.ner import (
+    NER_CONCURRENCY,
+    SceneFailure,
+    SceneResult,
+    extract_scenes,
+    normalize,
+)
+from mygobase.script import load_df, load_scenes
+
+# Compares the two-call and the joint extraction modes on the same scenes.
+# The response cache is bypassed so both modes pay for every request.
+
+
+def jaccard(a: Set, b: Set) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def signature(result: SceneResult) -> Tuple[Set[str], Set[Tuple[str, str]]]:
+    result = normalize(result)
+    pairs = {(r.source, r.target) for r in result.relations.relations}
+    return set(result.entities), pairs
+
+
+def run(scenes: List[tuple[int, str]], concurrency: int, joint: bool):
+    extractor = AsyncEntityRelationExtractor(bypass_cache=True)
+    start = time.perf_counter()
+    results = asyncio.run(
+        extract_scenes(extractor, scenes, concurrency, retries=0, joint=joint)
+    )
+    elapsed = time.perf_counter() - start
+    ok: Dict[int, SceneResult] = {
+        r.scene_id: r for r in results if isinstance(r, SceneResult)
+    }
+    failed = sum(1 for r in results if isinstance(r, SceneFailure))
+    return ok, failed, elapsed, extractor.client.chat.completions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--limit", type=int, default=50, help="scenes to compare")
+    parser.add_argument("--concurrency", type=int, default=NER_CONCURRENCY)
+    args = parser.parse_args()
+
+    scenes = load_scenes(load_df())[: args.limit]
+    two_call, two_call_failed, two_call_time, two_call_usage = run(
+        scenes, args.concurrency, joint=False
+    )
+    joint, joint_failed, joint_time, joint_usage = run(
+        scenes, args.concurrency, joint=True
+    )
+
+    for name, failed, elapsed, usage in (
+        ("two-call", two_call_failed, two_call_time, two_call_usage),
+        ("joint", joint_failed, joint_time, joint_usage),
+    ):
+        print(f"{name:>8}: {elapsed:.1f}s, {usage}, {failed} failed")
+
+    both = sorted(two_call.keys() & joint.keys())
+    entity_overlap = []
+    relation_overlap = []
+    for scene_id in both:
+        a_entities, a_pairs = signature(two_call[scene_id])
+        b_entities, b_pairs = signature(joint[scene_id])
+        entity_overlap.append(jaccard(a_entities, b_entities))
+        relation_overlap.append(jaccard(a_pairs, b_pairs))
+    if both:
+        print(
+            f"over {len(both)} scenes: entity jaccard "
+            f"{sum(entity_overlap) / len(both):.3f}, relation (source, target) "
+            f"jaccard {sum(relation_overlap) / len(both):.3f}"
+        )
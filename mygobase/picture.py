@@ -0,0 +1,170 @@
+import sqlite3
+from dataclasses import dataclass
+from enum import Enum
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import cv2
+import numpy as np
+
+
+class Codec(Enum):
+    PNG = "png"
+    WEBP = "webp"
+    JPEG = "jpeg"
+
+
+@dataclass(frozen=True)
+class ImageFormat:
+    codec: Codec = Codec.PNG
+    # Ignored by PNG, which is always lossless.
+    quality: int = 90
+
+    @property
+    def ext(self) -> str:
+        match self.codec:
+            case Codec.PNG:
+                return ".png"
+            case Codec.WEBP:
+                return ".webp"
+            case Codec.JPEG:
+                return ".jpg"
+
+    @property
+    def params(self) -> List[int]:
+        match self.codec:
+            case Codec.PNG:
+                return []
+            case Codec.WEBP:
+                return [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+            case Codec.JPEG:
+                return [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+
+
+@dataclass(frozen=True)
+class Tier:
+    name: str
+    # Target width in pixels, None keeps the source resolution.
+    width: Optional[int] = None
+
+
+type TierName = str
+
+FULL = Tier("full")
+THUMBNAIL = Tier("thumb", width=320)
+
+
+def resize(frame: cv2.typing.MatLike, width: Optional[int]) -> cv2.typing.MatLike:
+    h, w = frame.shape[:2]
+    if width is None or width >= w:
+        return frame
+    height = max(1, round(h * width / w))
+    return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def encode(
+    frame: cv2.typing.MatLike,
+    fmt: ImageFormat = ImageFormat(),
+    tiers: Sequence[Tier] = (FULL,),
+) -> Dict[TierName, bytes]:
+    return {
+        tier.name: cv2.imencode(fmt.ext, resize(frame, tier.width), fmt.params)[
+            1
+        ].tobytes()
+        for tier in tiers
+    }
+
+
+def dhash(frame: cv2.typing.MatLike, size: int = 8) -> int:
+    # Difference hash: one bit per horizontal brightness gradient on a
+    # size x size grid, robust to recompression and small colour shifts.
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+# Windows hashed besides the whole frame so a cropped screenshot still lands
+# near one of them: every scale (as a fraction of each side) at a
+# CROP_STEPS x CROP_STEPS grid of positions from corner to corner.
+CROP_SCALES = (0.9, 0.8)
+CROP_STEPS = 3
+# Windows are cut from the frame shrunk by this much first, which is far more
+# detail than an 8 x 9 hash needs and keeps hashing them cheap.
+CROP_DOWNSCALE = 4
+
+
+def crop_dhashes(frame: cv2.typing.MatLike, size: int = 8) -> List[int]:
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape
+    small = cv2.resize(
+        gray,
+        (max(size + 1, w // CROP_DOWNSCALE), max(size, h // CROP_DOWNSCALE)),
+        interpolation=cv2.INTER_AREA,
+    )
+    h, w = small.shape
+    res = []
+    for scale in CROP_SCALES:
+        ch, cw = round(h * scale), round(w * scale)
+        for y in np.linspace(0, h - ch, CROP_STEPS).round().astype(int):
+            for x in np.linspace(0, w - cw, CROP_STEPS).round().astype(int):
+                window = cv2.resize(
+                    small[y : y + ch, x : x + cw],
+                    (size + 1, size),
+                    interpolation=cv2.INTER_AREA,
+                )
+                bits = np.packbits(window[:, 1:] > window[:, :-1])
+                res.append(int.from_bytes(bits.tobytes(), "big"))
+    return res
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def find_picture(
+    conn: sqlite3.Connection, storyboard_id: int, tier: TierName = FULL.name
+) -> Optional[int]:
+    # Prefer the requested tier, fall back to the full frame when the tier was
+    # not generated at ingest.
+    row = conn.execute(
+        """
+        SELECT
+            frame_pictures.rowid
+        FROM
+            storyboards
+            JOIN frame_pictures ON frame_pictures.frame = storyboards.frame
+        WHERE
+            storyboards.id = ?
+            AND frame_pictures.tier IN (?, ?)
+        ORDER BY
+            frame_pictures.tier = ? DESC
+        LIMIT
+            1
+        """,
+        (storyboard_id, tier, FULL.name, tier),
+    ).fetchone()
+    return row[0] if row is not None else None
+
+
+def iter_picture(
+    conn: sqlite3.Connection,
+    storyboard_id: int,
+    tier: TierName = FULL.name,
+    chunk_size: int = 64 * 1024,
+) -> Iterator[bytes]:
+    rowid = find_picture(conn, storyboard_id, tier)
+    if rowid is None:
+        return
+    with conn.blobopen("frame_pictures", "picture", rowid, readonly=True) as blob:
+        while chunk := blob.read(chunk_size):
+            yield chunk
+
+
+def load_picture(
+    conn: sqlite3.Connection, storyboard_id: int, tier: TierName = FULL.name
+) -> Optional[bytes]:
+    rowid = find_picture(conn, storyboard_id, tier)
+    if rowid is None:
+        return None
+    with conn.blobopen("frame_pictures", "picture", rowid, readonly=True) as blob:
+        return blob.read()
@@ -0,0 +1,58 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from functools import cache
+from typing import Iterator, List
+
+from mygobase import DB_PATH
+from mygobase.bulk import connect
+
+POOL_SIZE = 8
+
+
+class ConnectionPool:
+    # Connections are opened on first demand with sqlite_vec loaded and the
+    # pragmas set, then handed to one thread at a time. They stay open, so
+    # each keeps its prepared statement cache across checkouts.
+    def __init__(self, path: str = DB_PATH, size: int = POOL_SIZE) -> None:
+        self.path = path
+        self.size = size
+        self.idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self.opened: List[sqlite3.Connection] = []
+        self.lock = threading.Lock()
+
+    def _checkout(self) -> sqlite3.Connection:
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.opened) < self.size:
+                conn = connect(self.path, check_same_thread=False)
+                self.opened.append(conn)
+                return conn
+        # Every connection is busy; wait for one to come back.
+        return self.idle.get()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        # Same transaction semantics as `with sqlite3.connect(...) as conn`.
+        conn = self._checkout()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.idle.put(conn)
+
+    def close(self):
+        with self.lock:
+            for conn in self.opened:
+                conn.close()
+            self.opened = []
+            self.idle = queue.LifoQueue()
+
+
+@cache
+def default_pool() -> ConnectionPool:
+    return ConnectionPool()
@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Self, Set, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+from tqdm import tqdm
+
+from mygobase import GRAPH_PPR_PATH, sidecar
+from mygobase.edges import collapse_edges
+from mygobase.llmtools.er import Entity
+from mygobase.pool import default_pool
+from mygobase.snapshot import Version, version
+
+# Personalized PageRank from every entity over the undirected graph, weighted
+# by edge weight: alpha * sum over h <= hops of ((1 - alpha) P)^h, so walks
+# longer than hops are cut off. Entries below epsilon are dropped after every
+# step and only the top neighbours per entity are kept.
+PPR_ALPHA = 0.15
+PPR_HOPS = 3
+PPR_TOP = 32
+PPR_EPSILON = 1e-4
+PPR_BATCH_SIZE = 512
+
+
+def transition(n: int, edges: List[Tuple[int, int, float]]) -> sp.csr_array:
+    # Row-stochastic walk matrix; an edge can be walked both ways.
+    sources = [s for s, t, _ in edges if s != t]
+    targets = [t for s, t, _ in edges if s != t]
+    weights = [w for s, t, w in edges if s != t]
+    adjacency = sp.coo_array(
+        (weights + weights, (sources + targets, targets + sources)), shape=(n, n)
+    ).tocsr()
+    degrees = np.asarray(adjacency.sum(axis=1)).ravel()
+    return (
+        sp.diags_array(1 / np.maximum(degrees, np.finfo(np.float64).tiny)) @ adjacency
+    )
+
+
+def pagerank_batch(
+    walk: sp.csr_array, seeds: np.ndarray, alpha: float, hops: int, epsilon: float
+) -> Tuple[sp.csr_array, sp.csr_array]:
+    # (scores, 1 + hop at which each entry first got mass) for every seed row.
+    n = walk.shape[0]
+    frontier = sp.csr_array(
+        (np.ones(len(seeds)), (np.arange(len(seeds)), seeds)), shape=(len(seeds), n)
+    )
+    scores = alpha * frontier
+    reached = frontier.copy()
+    for hop in range(1, hops + 1):
+        frontier = (1 - alpha) * (frontier @ walk)
+        frontier.data[frontier.data < epsilon] = 0
+        frontier.eliminate_zeros()
+        if frontier.nnz == 0:
+            break
+        scores = scores + alpha * frontier
+        new = frontier.copy()
+        new.data[:] = 1
+        new = new - new.multiply(reached != 0)
+        new.eliminate_zeros()
+        reached = reached + (hop + 1) * new
+    return sp.csr_array(scores), sp.csr_array(reached)
+
+
+class PPRIndex:
+    # Top PPR_TOP neighbours of every entity as CSR arrays (indptr,
+    # neighbours, scores, hops), one .npy each in a sidecar build next to the
+    # database like EntityIndex, memory-mapped on load.
+    def __init__(
+        self,
+        names: sidecar.Strings,
+        indptr: np.ndarray,
+        neighbours: np.ndarray,
+        scores: np.ndarray,
+        hops: np.ndarray,
+        version: Version,
+        params: Dict[str, float],
+    ) -> None:
+        # Sorted, so ids are found by binary search.
+        self.names = names
+        self.indptr = indptr
+        self.neighbours = neighbours
+        self.scores = scores
+        self.hops = hops
+        self.version = version
+        # alpha, hops, top and epsilon it was built with.
+        self.params = params
+
+    @classmethod
+    def build(
+        cls,
+        conn: sqlite3.Connection,
+        path: str = GRAPH_PPR_PATH,
+        alpha: float = PPR_ALPHA,
+        hops: int = PPR_HOPS,
+        top: int = PPR_TOP,
+        epsilon: float = PPR_EPSILON,
+    ) -> Self:
+        current = version(conn)
+        entities = {entity for (entity,) in conn.execute("SELECT entity FROM entity")}
+        edges = collapse_edges(conn, entities)
+        names = sorted({name for edge in edges for name in (edge.source, edge.target)})
+        ids = {name: i for i, name in enumerate(names)}
+        walk = transition(
+            len(names), [(ids[e.source], ids[e.target], float(e.weight)) for e in edges]
+        )
+
+        start = time.perf_counter()
+        counts = np.zeros(len(names), dtype=np.int64)
+        neighbours: List[np.ndarray] = []
+        scores: List[np.ndarray] = []
+        hop_lists: List[np.ndarray] = []
+        for batch in tqdm(
+            range(0, len(names), PPR_BATCH_SIZE), desc="personalized pagerank"
+        ):
+            seeds = np.arange(batch, min(batch + PPR_BATCH_SIZE, len(names)))
+            ppr, reached = pagerank_batch(walk, seeds, alpha, hops, epsilon)
+            reached.sort_indices()
+            ppr.sort_indices()
+            for row, seed in enumerate(seeds):
+                lo, hi = ppr.indptr[row], ppr.indptr[row + 1]
+                nodes, values = ppr.indices[lo:hi], ppr.data[lo:hi]
+                # Both rows have the same pattern, in the same order.
+                first = reached.data[reached.indptr[row] : reached.indptr[row + 1]]
+                keep = nodes != seed
+                nodes, values, first = nodes[keep], values[keep], first[keep]
+                if len(nodes) > top:
+                    best = np.argpartition(-values, top - 1)[:top]
+                    nodes, values, first = nodes[best], values[best], first[best]
+                order = np.lexsort((nodes, -values))
+                neighbours.append(nodes[order].astype(np.int32))
+                scores.append(values[order].astype(np.float32))
+                hop_lists.append((first[order] - 1).astype(np.uint8))
+                counts[seed] = len(order)
+        indptr = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        def concat(arrays: List[np.ndarray], dtype) -> np.ndarray:
+            return np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+
+        with sidecar.publish(path) as build:
+            for name, array in [
+                ("indptr", indptr),
+                ("neighbours", concat(neighbours, np.int32)),
+                ("scores", concat(scores, np.float32)),
+                ("hops", concat(hop_lists, np.uint8)),
+            ]:
+                np.save(os.path.join(build, f"{name}.npy"), array)
+            sidecar.write_strings(build, "names", names)
+            with open(os.path.join(build, "meta.json"), "w") as f:
+                json.dump(
+                    {
+                        "version": current,
+                        "params": {
+                            "alpha": alpha,
+                            "hops": hops,
+                            "top": top,
+                            "epsilon": epsilon,
+                        },
+                    },
+                    f,
+                )
+        print(
+            f"pagerank for {len(names)} entities in "
+            f"{time.perf_counter() - start:.1f}s, {int(indptr[-1])} neighbours kept"
+        )
+        return cls.load(path)  # type: ignore
+
+    @classmethod
+    def read(cls, build: str) -> Self:
+        with open(os.path.join(build, "meta.json")) as f:
+            meta = json.load(f)
+
+        def array(name: str) -> np.ndarray:
+            return np.load(os.path.join(build, f"{name}.npy"), mmap_mode="r")
+
+        return cls(
+            sidecar.read_strings(build, "names"),
+            array("indptr"),
+            array("neighbours"),
+            array("scores"),
+            array("hops"),
+            meta["version"],
+            meta["params"],
+        )
+
+    @classmethod
+    def load(cls, path: str = GRAPH_PPR_PATH) -> Optional[Self]:
+        return sidecar.read(path, cls.read)
+
+    @classmethod
+    def open(
+        cls, conn: sqlite3.Connection, path: str = GRAPH_PPR_PATH
+    ) -> Optional[Self]:
+        # None without a current sidecar, and expansion falls back to k-hop
+        # search on the graph. Only ner.py (or running this module) rebuilds it.
+        index = cls.load(path)
+        if index is None:
+            return None
+        if index.version != version(conn):
+            print("personalized pagerank is stale, expanding by hops instead")
+            return None
+        return index
+
+    def expand(
+        self, entities: Set[Entity], hops: int, budget: int
+    ) -> List[Tuple[Entity, float]]:
+        # Up to budget entities at most hops away from entities, ranked by
+        # their summed pagerank from them; entities themselves are left out.
+        seeds = {
+            node for entity in entities if (node := self.names.find(entity)) is not None
+        }
+        ranked: Dict[int, float] = defaultdict(float)
+        for seed in seeds:
+            lo, hi = int(self.indptr[seed]), int(self.indptr[seed + 1])
+            for node, score, hop in zip(
+                self.neighbours[lo:hi], self.scores[lo:hi], self.hops[lo:hi]
+            ):
+                if hop <= hops and node not in seeds:
+                    ranked[int(node)] += float(score)
+        best = sorted(ranked.items(), key=lambda item: (-item[1], item[0]))[:budget]
+        return [(self.names[node], score) for node, score in best]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", default=GRAPH_PPR_PATH)
+    parser.add_argument("--alpha", type=float, default=PPR_ALPHA)
+    parser.add_argument("--hops", type=int, default=PPR_HOPS)
+    parser.add_argument("--top", type=int, default=PPR_TOP)
+    parser.add_argument("--epsilon", type=float, default=PPR_EPSILON)
+    args = parser.parse_args()
+    with default_pool().connection() as conn:
+        PPRIndex.build(conn, args.path, args.alpha, args.hops, args.top, args.epsilon)
@@ -0,0 +1,56 @@
+from typing import List
+
+import cv2
+import numpy as np
+
+THUMBNAIL_SIZE = (32, 18)
+LEVELS = 4
+# A new scene starts after a long silence, or after a shorter one that comes
+# with a clear change of colours on screen.
+MAX_GAP_SECONDS = 10.0
+MIN_GAP_SECONDS = 2.0
+HIST_DISTANCE = 0.5
+# Scene ids are unique across episodes: episode * SCENE_STRIDE + local index.
+SCENE_STRIDE = 1000
+
+
+def thumbnail(frame: cv2.typing.MatLike) -> np.ndarray:
+    return cv2.resize(frame, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+
+
+def histograms(thumbnails: np.ndarray) -> np.ndarray:
+    # thumbnails: (n, h, w, 3) uint8 -> (n, LEVELS ** 3) normalized histograms,
+    # computed for the whole episode with one bincount.
+    n = thumbnails.shape[0]
+    q = (thumbnails.reshape(n, -1, 3) // (256 // LEVELS)).astype(np.int64)
+    bins = q[..., 0] * LEVELS * LEVELS + q[..., 1] * LEVELS + q[..., 2]
+    bins += (np.arange(n) * LEVELS**3)[:, None]
+    hist = np.bincount(bins.ravel(), minlength=n * LEVELS**3).reshape(n, -1)
+    return hist / hist.sum(axis=1, keepdims=True)
+
+
+def segment(thumbnails: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    # Frames are in time order; starts/ends are the subtitle timings (seconds)
+    # of the line each frame was taken for. Returns the local scene index of
+    # every frame.
+    n = thumbnails.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    hist = histograms(thumbnails)
+    # 1 - histogram intersection between consecutive frames.
+    distances = 1.0 - np.minimum(hist[1:], hist[:-1]).sum(axis=1)
+    gaps = np.maximum(starts[1:] - ends[:-1], 0.0)
+    cuts = (gaps > MAX_GAP_SECONDS) | (
+        (gaps > MIN_GAP_SECONDS) & (distances > HIST_DISTANCE)
+    )
+    return np.concatenate([[0], np.cumsum(cuts)])
+
+
+def scene_ids(epid: int, local: np.ndarray) -> List[int]:
+    # More scenes would take ids of the next episode.
+    if len(local) and local.max() >= SCENE_STRIDE:
+        raise ValueError(
+            f"episode {epid} has {local.max() + 1} scenes, "
+            f"scene ids only have room for {SCENE_STRIDE}"
+        )
+    return (epid * SCENE_STRIDE + local).tolist()
@@ -0,0 +1,47 @@
+import sqlite3
+from typing import List, Optional
+
+import polars as pl
+
+from mygobase import DB_PATH
+
+# Scene scripts as ner.py reads them, built from the storyboards. Kept free of
+# the NER pipeline so the migrations in db.py can rebuild them too.
+
+
+def load_df(conn: Optional[sqlite3.Connection] = None):
+    if conn is None:
+        with sqlite3.connect(DB_PATH) as conn:
+            return load_df(conn)
+    df = pl.read_database(
+        """
+            SELECT
+                id,
+                scene,
+                frame_number,
+                role,
+                subtitle
+            FROM
+                storyboards
+            WHERE
+                -- negative episodes are staged by an ingest still running
+                -- (or one that crashed), see staging_episode
+                episode >= 0
+            ORDER BY
+                scene,
+                frame_number
+            """,
+        connection=conn,
+    )
+    return df
+
+
+def load_scenes(df: pl.DataFrame) -> List[tuple[int, str]]:
+    scene_docs: List[tuple[int, str]] = []
+    for (scene_id,), scene_db in df.group_by("scene", maintain_order=True):
+        script = ""
+        for role, subtitle in scene_db.select(["role", "subtitle"]).iter_rows():
+            script += f"{role.strip()}:{subtitle.strip()}\n"
+        scene_docs.append((scene_id, script))  # type: ignore
+    print("load scenes completed")
+    return scene_docs
@@ -0,0 +1,117 @@
+import fcntl
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+
+import numpy as np
+
+# Files derived from the database (graph snapshot, entity index, pagerank) are
+# written as a whole directory per build, and path is a symlink to the current
+# one. Swapping the symlink is a single rename, so a reader sees either the old
+# build or the new one, never a half-written or missing one.
+
+
+@contextmanager
+def publish(path: str) -> Iterator[str]:
+    # Yields an empty directory to write the new build into; it replaces path
+    # once the block exits without raising. Builds of the same path are
+    # serialized by a lock file next to it.
+    parent, base = os.path.split(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        build = tempfile.mkdtemp(prefix=f"{base}.", dir=parent)
+        try:
+            yield build
+        except BaseException:
+            shutil.rmtree(build, ignore_errors=True)
+            raise
+        os.chmod(build, 0o755)
+        link = f"{build}.link"
+        os.symlink(os.path.basename(build), link)
+        previous = os.path.realpath(path) if os.path.islink(path) else None
+        os.replace(link, path)
+        # Readers resolve the symlink once when they open a build, so the one
+        # just replaced is kept for those that are still opening it.
+        for entry in os.listdir(parent):
+            other = os.path.join(parent, entry)
+            if (
+                entry.startswith(f"{base}.")
+                and other not in (build, previous)
+                and os.path.isdir(other)
+                and not os.path.islink(other)
+            ):
+                shutil.rmtree(other, ignore_errors=True)
+
+
+def read[T](path: str, load: Callable[[str], T], attempts: int = 3) -> Optional[T]:
+    # load() on the build path currently points at, None when there is none.
+    # A build is deleted once two newer ones are swapped in, which can happen
+    # while it is being opened; the current one is tried instead.
+    for _ in range(attempts):
+        if not os.path.exists(path):
+            return None
+        try:
+            return load(os.path.realpath(path))
+        except FileNotFoundError:
+            continue
+    return None
+
+
+class Strings:
+    # Read-only view of strings packed into one blob addressed by an offsets
+    # array, see write_strings.
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray) -> None:
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __iter__(self) -> Iterator[str]:
+        return (self[i] for i in range(len(self)))
+
+    def raw(self, i: int) -> bytes:
+        return self.blob[self.offsets[i] : self.offsets[i + 1]].tobytes()
+
+    def __getitem__(self, i: int) -> str:
+        return self.raw(i).decode()
+
+    def find(self, s: str) -> Optional[int]:
+        # Binary search for strings written in sorted order, comparing UTF-8
+        # bytes, which sort the same way as the str code points.
+        key = s.encode()
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.raw(lo) == key:
+            return lo
+        return None
+
+
+def write_strings(build: str, name: str, strings: List[str]):
+    # {name}.bin holds the UTF-8 bytes of every string back to back and
+    # {name}.offsets.npy where each one starts, so loading them is two mmaps.
+    encoded = [s.encode() for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    with open(os.path.join(build, f"{name}.bin"), "wb") as f:
+        f.write(b"".join(encoded))
+    np.save(os.path.join(build, f"{name}.offsets.npy"), offsets)
+
+
+def read_strings(build: str, name: str) -> Strings:
+    path = os.path.join(build, f"{name}.bin")
+    # np.memmap refuses empty files.
+    if os.path.getsize(path) == 0:
+        blob = np.zeros(0, dtype=np.uint8)
+    else:
+        blob = np.memmap(path, dtype=np.uint8, mode="r")
+    offsets = np.load(os.path.join(build, f"{name}.offsets.npy"), mmap_mode="r")
+    return Strings(blob, offsets)
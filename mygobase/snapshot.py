@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import sqlite3
+from typing import Dict, Iterator, List, Optional, Self, Tuple
+
+import numpy as np
+
+from mygobase import DB_PATH, GRAPH_SNAPSHOT_PATH, sidecar, versions
+from mygobase.edges import Edge, collapse_edges
+
+# A compiled, read-only copy of the knowledge graph. Entities are interned as
+# ids in sorted name order, adjacency is CSR (indptr/targets by source id) and
+# every string lives in a blob addressed by an offsets array, so loading is a
+# handful of mmaps whatever the size of the graph. Entities point at scene ids
+# (CSR again); scene titles and scripts are stored once, keyed by sorted id.
+
+# Bumped whenever the files written change, so older snapshots get rebuilt.
+FORMAT = 4
+
+type Version = int
+
+
+def version(conn: sqlite3.Connection) -> Version:
+    return versions.get(conn, versions.GRAPH)
+
+
+def write(conn: sqlite3.Connection, path: str = GRAPH_SNAPSHOT_PATH):
+    current = version(conn)
+    contents: Dict[str, List[int]] = {
+        entity: json.loads(scene_ids)
+        for entity, scene_ids in conn.execute("SELECT entity, scenes FROM entity")
+    }
+    # Same graph as MyGOKnowledgeGraph.from_db: an entity is a node once an
+    # edge between two known entities mentions it.
+    unordered = collapse_edges(conn, contents)
+    names = sorted({name for edge in unordered for name in (edge.source, edge.target)})
+    ids = {name: i for i, name in enumerate(names)}
+    sources = np.array([ids[edge.source] for edge in unordered], dtype=np.int32)
+    edges = [unordered[i] for i in np.argsort(sources, kind="stable")]
+    indptr = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(names)), out=indptr[1:])
+    targets = np.array([ids[edge.target] for edge in edges], dtype=np.int32)
+    # The same edges grouped by target, to walk the graph against direction.
+    in_edge_ids = np.argsort(targets, kind="stable")
+    in_sources = np.sort(sources)[in_edge_ids]
+    in_indptr = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(targets, minlength=len(names)), out=in_indptr[1:])
+    weights = np.array([edge.weight for edge in edges], dtype=np.int32)
+    edge_scene_indptr = np.zeros(len(edges) + 1, dtype=np.int64)
+    np.cumsum([len(edge.scenes) for edge in edges], out=edge_scene_indptr[1:])
+    edge_scenes = np.array(
+        [scene_id for edge in edges for scene_id in edge.scenes], dtype=np.int64
+    )
+    relation_indptr = np.zeros(len(edges) + 1, dtype=np.int64)
+    np.cumsum([len(edge.relations) for edge in edges], out=relation_indptr[1:])
+    scene_indptr = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([len(contents[name]) for name in names], out=scene_indptr[1:])
+    entity_scenes = np.array(
+        [scene_id for name in names for scene_id in contents[name]], dtype=np.int64
+    )
+    scene_rows = conn.execute(
+        "SELECT id, title, script FROM scenes ORDER BY id"
+    ).fetchall()
+    scene_keys = np.array([scene_id for scene_id, _, _ in scene_rows], dtype=np.int64)
+
+    with sidecar.publish(path) as build:
+        for name, strings in [
+            ("names", names),
+            ("relations", [text for edge in edges for text in edge.relations]),
+            ("titles", [title for _, title, _ in scene_rows]),
+            ("scripts", [script for _, _, script in scene_rows]),
+        ]:
+            sidecar.write_strings(build, name, strings)
+        arrays: List[Tuple[str, np.ndarray]] = [
+            ("indptr", indptr),
+            ("targets", targets),
+            ("in_indptr", in_indptr),
+            ("in_sources", in_sources),
+            ("in_edge_ids", in_edge_ids),
+            ("weights", weights),
+            ("edge_scene_indptr", edge_scene_indptr),
+            ("edge_scenes", edge_scenes),
+            ("relation_indptr", relation_indptr),
+            ("scene_indptr", scene_indptr),
+            ("entity_scenes", entity_scenes),
+            ("scene_keys", scene_keys),
+        ]
+        for name, array in arrays:
+            np.save(os.path.join(build, f"{name}.npy"), array)
+        with open(os.path.join(build, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "format": FORMAT,
+                    "version": current,
+                    "entities": len(names),
+                    "edges": len(edges),
+                    "scenes": len(scene_rows),
+                },
+                f,
+            )
+    print(
+        f"graph snapshot: {len(names)} entities, {len(edges)} edges, "
+        f"{len(scene_rows)} scenes"
+    )
+
+
+class GraphSnapshot:
+    def __init__(self, path: str) -> None:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.format: int = meta.get("format", 0)
+        self.version: Version = meta["version"]
+        if self.format != FORMAT:
+            return
+
+        def array(name: str) -> np.ndarray:
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.names = sidecar.read_strings(path, "names")
+        self.relations = sidecar.read_strings(path, "relations")
+        self.indptr = array("indptr")
+        self.targets = array("targets")
+        self.in_indptr = array("in_indptr")
+        self.in_sources = array("in_sources")
+        self.in_edge_ids = array("in_edge_ids")
+        self.weights = array("weights")
+        self.edge_scene_indptr = array("edge_scene_indptr")
+        self.edge_scenes = array("edge_scenes")
+        self.relation_indptr = array("relation_indptr")
+        self.scene_indptr = array("scene_indptr")
+        self.entity_scenes = array("entity_scenes")
+        self.scene_keys = array("scene_keys")
+        self.titles = sidecar.read_strings(path, "titles")
+        self.scripts = sidecar.read_strings(path, "scripts")
+
+    @classmethod
+    def open(
+        cls, conn: sqlite3.Connection, path: str = GRAPH_SNAPSHOT_PATH
+    ) -> Optional[Self]:
+        # None when missing or older than the tables it was compiled from.
+        snapshot = sidecar.read(path, cls)
+        if (
+            snapshot is None
+            or snapshot.format != FORMAT
+            or snapshot.version != version(conn)
+        ):
+            return None
+        return snapshot
+
+    def find(self, name: str) -> Optional[int]:
+        return self.names.find(name)
+
+    def out_edges(self, node: int) -> Iterator[Tuple[int, int]]:
+        # (target id, edge index) of every edge leaving node.
+        start, end = int(self.indptr[node]), int(self.indptr[node + 1])
+        for edge in range(start, end):
+            yield int(self.targets[edge]), edge
+
+    def in_edges(self, node: int) -> Iterator[Tuple[int, int]]:
+        # (source id, edge index) of every edge entering node.
+        start, end = int(self.in_indptr[node]), int(self.in_indptr[node + 1])
+        for i in range(start, end):
+            yield int(self.in_sources[i]), int(self.in_edge_ids[i])
+
+    def edge(self, source: int, target: int, edge: int) -> Edge:
+        scenes = self.edge_scenes[
+            int(self.edge_scene_indptr[edge]) : int(self.edge_scene_indptr[edge + 1])
+        ]
+        texts = range(
+            int(self.relation_indptr[edge]), int(self.relation_indptr[edge + 1])
+        )
+        return Edge(
+            self.names[source],
+            self.names[target],
+            int(self.weights[edge]),
+            scenes.tolist(),
+            [self.relations[i] for i in texts],
+        )
+
+    def scenes(self, node: int) -> List[int]:
+        start, end = int(self.scene_indptr[node]), int(self.scene_indptr[node + 1])
+        return self.entity_scenes[start:end].tolist()
+
+    def scene(self, scene_id: int) -> Optional[Tuple[str, str]]:
+        # (title, script) of a scene, None when it is not stored.
+        i = int(np.searchsorted(self.scene_keys, scene_id))
+        if i == len(self.scene_keys) or self.scene_keys[i] != scene_id:
+            return None
+        return self.titles[i], self.scripts[i]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", default=GRAPH_SNAPSHOT_PATH)
+    args = parser.parse_args()
+    with sqlite3.connect(DB_PATH) as conn:
+        write(conn, args.path)
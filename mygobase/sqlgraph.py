@@ -0,0 +1,65 @@
+import argparse
+import json
+import sqlite3
+from typing import Optional
+
+from mygobase import DB_PATH
+from mygobase.bulk import connect
+from mygobase.edges import collapse_edges
+from mygobase.snapshot import Version, version
+
+# The knowledge graph as indexed adjacency tables (graph_nodes, graph_edges,
+# see db.py), so a process only reads the rows a query touches. Derived from
+# entity/ner like the snapshot and rebuilt when those change.
+
+
+def stored_version(conn: sqlite3.Connection) -> Optional[Version]:
+    row = conn.execute("SELECT version FROM graph_version").fetchone()
+    return row[0] if row is not None else None
+
+
+def is_current(conn: sqlite3.Connection) -> bool:
+    return stored_version(conn) == version(conn)
+
+
+def write(conn: sqlite3.Connection):
+    current = version(conn)
+    entities = {entity for (entity,) in conn.execute("SELECT entity FROM entity")}
+    edges = collapse_edges(conn, entities)
+    nodes = sorted({name for edge in edges for name in (edge.source, edge.target)})
+    # One transaction, so readers see either the old graph or the new one.
+    with conn:
+        conn.execute("DELETE FROM graph_edges")
+        conn.execute("DELETE FROM graph_nodes")
+        conn.executemany(
+            "INSERT INTO graph_nodes (entity) VALUES (?)", [(node,) for node in nodes]
+        )
+        conn.executemany(
+            """
+            INSERT INTO graph_edges (source, target, weight, scenes, relations)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    edge.source,
+                    edge.target,
+                    edge.weight,
+                    json.dumps(edge.scenes),
+                    json.dumps(edge.relations, ensure_ascii=False),
+                )
+                for edge in edges
+            ],
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO graph_version (id, version) VALUES (0, ?)",
+            (current,),
+        )
+    print(f"graph tables: {len(nodes)} entities, {len(edges)} edges")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", default=DB_PATH)
+    args = parser.parse_args()
+    with connect(args.path) as conn:
+        write(conn)
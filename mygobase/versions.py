@@ -0,0 +1,28 @@
+import sqlite3
+
+# Counters of changes to the tables derived data is built from. Every writer
+# bumps the counter in the transaction that changes the tables, and derived
+# data (sidecars, graph tables) stores the counter it was built from, so
+# telling it is stale is one row lookup whatever the size of the graph.
+
+# entity, ner and scenes
+GRAPH = "graph"
+# entity_embedding
+EMBEDDING = "embedding"
+
+
+def get(conn: sqlite3.Connection, name: str) -> int:
+    row = conn.execute(
+        "SELECT version FROM versions WHERE name = ?", (name,)
+    ).fetchone()
+    return row[0] if row is not None else 0
+
+
+def bump(conn: sqlite3.Connection, name: str):
+    conn.execute(
+        """
+        INSERT INTO versions (name, version) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1
+        """,
+        (name,),
+    )
@@ -0,0 +1,60 @@
+import json
+import random
+import sqlite3
+from typing import Iterator
+
+import pytest
+
+from mygobase import DB_PATH, db
+from mygobase.bulk import connect
+from mygobase.pool import default_pool
+
+ENTITIES = [f"e{i:02d}" for i in range(16)]
+SCENES = 40
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch) -> Iterator:
+    # A migrated, empty database at the default paths under tmp_path.
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "db").mkdir()
+    default_pool.cache_clear()
+    conn = connect(DB_PATH)
+    db.migrate(conn)
+    yield conn
+    conn.close()
+    default_pool().close()
+    default_pool.cache_clear()
+
+
+@pytest.fixture
+def graph_db(database) -> sqlite3.Connection:
+    # A small knowledge graph: every scene relates a few random entities,
+    # some relations name entities that are not in the entity table, and one
+    # entity has no relations at all.
+    conn = database
+    rng = random.Random(0)
+    appearances = {entity: [] for entity in ENTITIES}
+    for scene in range(SCENES):
+        members = rng.sample(ENTITIES[:-1], 4)
+        relations = [
+            {"source": source, "target": target, "relation": f"r{rng.randrange(3)}"}
+            for source, target in zip(members, members[1:] + ["unknown"])
+        ]
+        for entity in members:
+            appearances[entity].append(scene)
+        conn.execute(
+            "INSERT INTO ner (scene, ner, entities) VALUES (?, ?, ?)",
+            (scene, json.dumps({"relations": relations}), json.dumps(members)),
+        )
+        conn.execute(
+            "INSERT INTO scenes (id, title, script) VALUES (?, ?, ?)",
+            (scene, f"scene {scene}", f"{members[0]}:line {scene}"),
+        )
+    appearances[ENTITIES[-1]].append(0)
+    conn.executemany(
+        "INSERT INTO entity (entity, scenes) VALUES (?, ?)",
+        [(entity, json.dumps(scenes)) for entity, scenes in appearances.items()],
+    )
+    conn.commit()
+    return conn
@@ -0,0 +1,94 @@
+import pytest
+from openai.types.chat import ChatCompletion
+
+from mygobase.llmtools import cache
+from mygobase.llmtools.cache import ResponseCache
+
+
+def completion(content: str, finish_reason: str = "stop") -> ChatCompletion:
+    return ChatCompletion.model_validate(
+        {
+            "id": content,
+            "object": "chat.completion",
+            "created": 0,
+            "model": "m",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": finish_reason,
+                    "message": {"role": "assistant", "content": content},
+                }
+            ],
+        }
+    )
+
+
+def request(i: int):
+    return {"model": "m", "messages": [{"role": "user", "content": str(i)}]}
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "time", clock)
+    return clock
+
+
+def rows(response_cache: ResponseCache) -> int:
+    return response_cache.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+def test_round_trip(tmp_path, clock):
+    response_cache = ResponseCache(str(tmp_path / "cache.db"))
+    assert response_cache.get(request(0)) is None
+    response_cache.put(request(0), completion("a"))
+    response_cache.put(request(1), completion("b", finish_reason="length"))
+    hit = response_cache.get(request(0))
+    assert hit is not None and hit.choices[0].message.content == "a"
+    assert response_cache.get(request(1)) is None
+    assert (response_cache.hits, response_cache.misses) == (1, 2)
+
+
+def test_expired_entries_are_not_returned(tmp_path, clock):
+    response_cache = ResponseCache(str(tmp_path / "cache.db"), ttl=10)
+    response_cache.put(request(0), completion("a"))
+    clock.now += 11
+    assert response_cache.get(request(0)) is None
+    assert rows(response_cache) == 0
+
+
+def test_evicts_every_few_puts(tmp_path, clock):
+    response_cache = ResponseCache(
+        str(tmp_path / "cache.db"), ttl=100, max_entries=3, evict_every=4
+    )
+    for i in range(3):
+        response_cache.put(request(i), completion(str(i)))
+        clock.now += 1
+    # Used since, so the least recently used entry is 1 and not 0.
+    assert response_cache.get(request(0)) is not None
+    clock.now += 1
+    response_cache.put(request(3), completion("3"))
+    assert rows(response_cache) == 3
+    assert response_cache.get(request(1)) is None
+    assert response_cache.get(request(0)) is not None
+    # Between evictions the table may grow past max_entries.
+    for i in range(4, 7):
+        response_cache.put(request(i), completion(str(i)))
+    assert rows(response_cache) == 6
+
+
+def test_evicts_expired_on_open(tmp_path, clock):
+    path = str(tmp_path / "cache.db")
+    response_cache = ResponseCache(path, ttl=10)
+    response_cache.put(request(0), completion("a"))
+    response_cache.conn.close()
+    clock.now += 11
+    assert rows(ResponseCache(path, ttl=10)) == 0
@@ -0,0 +1,130 @@
+import json
+
+from mygobase.bulk import connect
+from mygobase.db import migrate, migrate_scene_store
+from mygobase.script import load_df, load_scenes
+
+LINES = {
+    # scene -> (role, subtitle) of its lines
+    1: [("燈", "a"), ("愛音", "b")],
+    2: [("立希", "c")],
+    3: [("燈", "d"), ("爽世", "e")],
+}
+# scene -> entities, as the first ner.py extracted them
+ENTITIES = {1: ["燈", "愛音"], 2: ["立希"], 3: ["燈", "爽世"]}
+
+
+def storyboards(conn):
+    # ner rows as the first ner.py left them, without entities.
+    frame_number = 0
+    for scene, lines in LINES.items():
+        for role, subtitle in lines:
+            conn.execute(
+                "INSERT INTO storyboards (episode, frame_number, subtitle, role, scene) VALUES (1, ?, ?, ?, ?)",
+                (frame_number, subtitle, role, scene),
+            )
+            frame_number += 1
+        conn.execute(
+            "INSERT INTO ner (scene, ner) VALUES (?, ?)",
+            (scene, json.dumps({"relations": []})),
+        )
+    conn.commit()
+
+
+def entity_contents(conn, contents):
+    # entity as the first ner.py left it, with a copy of every script.
+    conn.execute("DROP TABLE entity")
+    conn.execute("CREATE TABLE entity (entity TEXT PRIMARY KEY, content JSON NOT NULL)")
+    conn.executemany(
+        "INSERT INTO entity (entity, content) VALUES (?, ?)",
+        [
+            (entity, json.dumps({"contents": items}, ensure_ascii=False))
+            for entity, items in contents.items()
+        ],
+    )
+    conn.commit()
+
+
+def contents_of(conn):
+    storyboards(conn)
+    scripts = dict(load_scenes(load_df(conn)))
+    contents = {}
+    for scene, entities in ENTITIES.items():
+        for entity in entities:
+            contents.setdefault(entity, []).append(
+                {"title": ", ".join(entities), "content": scripts[scene]}
+            )
+    return scripts, contents
+
+
+def tables(conn):
+    return {name for (name,) in conn.execute("SELECT name FROM sqlite_master")}
+
+
+def test_recovers_scenes_without_ner_entities(database):
+    scripts, contents = contents_of(database)
+    entity_contents(database, contents)
+    migrate_scene_store(database)
+    entities = {
+        entity: json.loads(scenes)
+        for entity, scenes in database.execute("SELECT entity, scenes FROM entity")
+    }
+    assert entities == {"燈": [1, 3], "愛音": [1], "立希": [2], "爽世": [3]}
+    assert database.execute("SELECT id, title, script FROM scenes").fetchall() == [
+        (1, "燈, 愛音", scripts[1]),
+        (2, "立希", scripts[2]),
+        (3, "燈, 爽世", scripts[3]),
+    ]
+    assert "entity_legacy" not in tables(database)
+
+
+def test_keeps_scripts_it_cannot_place(database):
+    scripts, contents = contents_of(database)
+    contents["立希"].append({"title": "立希", "content": "立希:gone\n"})
+    entity_contents(database, contents)
+    migrate_scene_store(database)
+    (scenes,) = database.execute(
+        "SELECT scenes FROM entity WHERE entity = '立希'"
+    ).fetchone()
+    assert json.loads(scenes) == [2]
+    (legacy,) = database.execute(
+        "SELECT content FROM entity_legacy WHERE entity = '立希'"
+    ).fetchone()
+    assert "立希:gone\n" in [c["content"] for c in json.loads(legacy)["contents"]]
+
+
+def test_moves_inline_pictures(tmp_path):
+    # storyboards as the first db.py created it.
+    conn = connect(str(tmp_path / "mygo.db"))
+    conn.execute(
+        """
+        CREATE TABLE storyboards (
+            id INTEGER PRIMARY KEY,
+            episode INT NOT NULL,
+            frame_number INT NOT NULL,
+            subtitle TEXT NOT NULL,
+            picture BLOB NOT NULL
+        )
+        """
+    )
+    conn.executemany(
+        "INSERT INTO storyboards (episode, frame_number, subtitle, picture) VALUES (1, ?, ?, ?)",
+        [(0, "a", b"png 0"), (24, "b", b"png 1")],
+    )
+    conn.commit()
+    migrate(conn)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(storyboards)")}
+    assert "picture" not in columns
+    assert conn.execute(
+        """
+        SELECT storyboards.subtitle, frames.frame_number, tier, codec, picture
+        FROM storyboards
+        JOIN frames ON frames.id = storyboards.frame
+        JOIN frame_pictures ON frame_pictures.frame = frames.id
+        ORDER BY storyboards.id
+        """
+    ).fetchall() == [
+        ("a", 0, "full", "png", b"png 0"),
+        ("b", 24, "full", "png", b"png 1"),
+    ]
+    conn.close()
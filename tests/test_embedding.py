@@ -0,0 +1,41 @@
+import numpy as np
+
+from mygobase.llmtools.embedding import EmbeddingCache
+
+
+def vectors(n: int, dim: int = 4) -> np.ndarray:
+    return np.arange(n * dim, dtype=np.float32).reshape(n, dim)
+
+
+def test_other_model_misses(tmp_path):
+    path = str(tmp_path / "embedding.db")
+    EmbeddingCache(path, model="a").put_many(["x", "y"], vectors(2))
+    same = EmbeddingCache(path, model="a")
+    found = same.get_many(["x", "y"])
+    assert np.array_equal(found[1], vectors(2)[1])
+    assert same.disk_hits == 2
+    other = EmbeddingCache(path, model="b")
+    assert other.get_many(["x", "y"]) == {}
+    assert other.misses == 2
+
+
+def test_lru_stays_within_budget(tmp_path):
+    embeddings = vectors(3)
+    row = embeddings[0].nbytes
+    embedding_cache = EmbeddingCache(str(tmp_path / "embedding.db"), max_bytes=2 * row)
+    embedding_cache.put_many(["x", "y"], embeddings[:2])
+    assert embedding_cache.lru_bytes == 2 * row
+    # Used since, so y and not x goes when z comes in.
+    embedding_cache.get_many(["x"])
+    embedding_cache.put_many(["z"], embeddings[2:])
+    assert embedding_cache.lru_bytes == 2 * row
+    assert set(embedding_cache.lru) == {
+        embedding_cache.key("x"),
+        embedding_cache.key("z"),
+    }
+    # Putting a cached text again does not count its bytes twice.
+    embedding_cache.put_many(["z"], embeddings[2:])
+    assert embedding_cache.lru_bytes == 2 * row
+    found = embedding_cache.get_many(["x", "y", "z"])
+    assert (embedding_cache.hits, embedding_cache.disk_hits) == (3, 1)
+    assert np.array_equal(found[1], embeddings[1])
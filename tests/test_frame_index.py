@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+import pytest
+
+from mygobase.frame_index import build, search
+
+FRAMES = 60
+
+
+def picture(seed: int) -> np.ndarray:
+    # Smooth random blobs, so frames differ at the scale dHash looks at.
+    noise = np.random.default_rng(seed).standard_normal((9, 16, 3))
+    frame = cv2.resize(noise.astype(np.float32), (640, 360), cv2.INTER_CUBIC)
+    return cv2.normalize(frame, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+
+def screenshot(frame: np.ndarray, top: float, left: float, size: float) -> bytes:
+    # A recompressed, downscaled crop of frame.
+    h, w = frame.shape[:2]
+    y, x = round(h * top), round(w * left)
+    crop = frame[y : y + round(h * size), x : x + round(w * size)]
+    crop = cv2.resize(crop, (crop.shape[1] // 2, crop.shape[0] // 2))
+    return cv2.imencode(".jpg", crop, [cv2.IMWRITE_JPEG_QUALITY, 70])[1].tobytes()
+
+
+@pytest.fixture
+def frames(database):
+    conn = database
+    for i in range(FRAMES):
+        # The last frames belong to an episode still being ingested.
+        episode = 1 if i < FRAMES - 5 else -2
+        conn.execute(
+            "INSERT INTO frames (id, episode, frame_number) VALUES (?, ?, ?)",
+            (i + 1, episode, i),
+        )
+        conn.execute(
+            "INSERT INTO frame_pictures (frame, tier, codec, picture) VALUES (?, 'full', 'png', ?)",
+            (i + 1, cv2.imencode(".png", picture(i))[1].tobytes()),
+        )
+        conn.execute(
+            "INSERT INTO storyboards (episode, frame_number, subtitle, frame) VALUES (?, ?, ?, ?)",
+            (episode, i, f"line {i}", i + 1),
+        )
+    conn.commit()
+    build(conn)
+    return conn
+
+
+@pytest.mark.parametrize(
+    "top, left, size",
+    [(0, 0, 1), (0.05, 0.05, 0.9), (0, 0.2, 0.8), (0.1, 0.03, 0.87), (0.15, 0, 0.85)],
+)
+def test_finds_cropped_screenshots(frames, top, left, size):
+    for i in range(0, FRAMES - 5, 5):
+        matches = search(frames, screenshot(picture(i), top, left, size), k=3)
+        assert matches and matches[0].subtitle == f"line {i}"
+
+
+def test_skips_staged_frames(frames):
+    matches = search(frames, screenshot(picture(FRAMES - 1), 0, 0, 1))
+    assert all(match.episode >= 0 for match in matches)
+
+
+def test_rejects_undecodable_images(frames):
+    with pytest.raises(ValueError):
+        search(frames, b"not an image")
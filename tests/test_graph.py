@@ -0,0 +1,104 @@
+import random
+
+import numpy as np
+import pytest
+
+from mygobase import snapshot, sqlgraph, versions
+from mygobase.entity_index import EntityIndex
+from mygobase.graph import (
+    GraphBackend,
+    MyGOKnowledgeGraph,
+    SnapshotKnowledgeGraph,
+    SQLKnowledgeGraph,
+    load_graph,
+)
+from mygobase.snapshot import GraphSnapshot
+
+from .conftest import ENTITIES
+
+
+@pytest.fixture
+def backends(graph_db):
+    rng = np.random.default_rng(0)
+    graph_db.executemany(
+        "INSERT INTO entity_embedding (entity, embedding) VALUES (?, ?)",
+        [
+            (entity, rng.standard_normal(768).astype(np.float32).tobytes())
+            for entity in ENTITIES
+        ],
+    )
+    graph_db.commit()
+    EntityIndex.build(graph_db)
+    snapshot.write(graph_db)
+    sqlgraph.write(graph_db)
+    graphs = {backend: load_graph(backend=backend) for backend in GraphBackend}
+    assert isinstance(graphs[GraphBackend.MEMORY], MyGOKnowledgeGraph)
+    assert isinstance(graphs[GraphBackend.SNAPSHOT], SnapshotKnowledgeGraph)
+    assert isinstance(graphs[GraphBackend.SQL], SQLKnowledgeGraph)
+    return graphs
+
+
+def same(backends, query):
+    # query answered by every backend, all equal to the in-memory graph's.
+    expected = query(backends[GraphBackend.MEMORY])
+    for backend, graph in backends.items():
+        assert query(graph) == expected, backend
+    return expected
+
+
+def test_entities(backends):
+    for entity in ENTITIES + ["unknown", ""]:
+        same(backends, lambda graph: graph.has_entity(entity))
+        same(backends, lambda graph: graph.search_entity(entity))
+        same(backends, lambda graph: graph.neighbours(entity))
+    assert same(backends, lambda graph: graph.has_entity(ENTITIES[-1])) is False
+
+
+def test_scenes(backends):
+    scene_ids = [3, 0, 39, 3, 1000]
+    contents = same(backends, lambda graph: graph.load_scenes(scene_ids))
+    assert [c.scene for c in contents] == [3, 0, 39, 3]
+
+
+def test_edges_and_hops(backends):
+    rng = random.Random(1)
+    for size in [1, 2, 4, 8, len(ENTITIES)]:
+        entities = set(rng.sample(ENTITIES, size)) | {"unknown"}
+        edges = same(
+            backends,
+            lambda graph: sorted(graph.edges_between(entities)),
+        )
+        assert all(
+            edge.source in entities and edge.target in entities for edge in edges
+        )
+        for hops in range(4):
+            same(backends, lambda graph: graph.k_hop(entities, hops))
+
+
+def test_similar_entities(backends):
+    queries = np.random.default_rng(1).standard_normal((4, 768)).astype(np.float32)
+    ranked = same(
+        backends, lambda graph: graph.rank_similar_embeddings(queries, 5, -1.0)
+    )
+    knn_graph = MyGOKnowledgeGraph.from_db(use_index=False)
+    assert [
+        [e for e, _ in r] for r in knn_graph.rank_similar_embeddings(queries, 5, -1.0)
+    ] == [[e for e, _ in r] for r in ranked]
+
+
+def test_stale_graph_is_not_used(backends, graph_db):
+    graph_db.execute(
+        "INSERT INTO scenes (id, title, script) VALUES (1000, 'new', 'new')"
+    )
+    versions.bump(graph_db, versions.GRAPH)
+    graph_db.commit()
+    for backend in GraphBackend:
+        assert isinstance(load_graph(backend=backend), MyGOKnowledgeGraph)
+
+
+def test_embedding_changes_leave_the_graph_current(backends, graph_db):
+    versions.bump(graph_db, versions.EMBEDDING)
+    graph_db.commit()
+    assert GraphSnapshot.open(graph_db) is not None
+    assert sqlgraph.is_current(graph_db)
+    assert EntityIndex.open(graph_db) is None
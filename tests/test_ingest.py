@@ -0,0 +1,102 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+import pytest
+
+from mygobase.extract_storyboard import abandon, end_marker, ingest
+
+HEADER = """[Script Info]
+ScriptType: v4.00+
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+
+class Executor:
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False) -> None:
+        pass
+
+
+def test_abandon_waits_for_end_markers():
+    # An episode finishing while the queue is full: its done callback blocks
+    # on put after the future is already done.
+    batches: queue.Queue = queue.Queue(maxsize=1)
+    batches.put((1, []))
+    finished: Future = Future()
+    finished.add_done_callback(end_marker(1, batches))
+    cancelled: Future = Future()
+    cancelled.add_done_callback(end_marker(2, batches))
+    cancelled.cancel()
+    worker = threading.Thread(target=finished.set_result, args=({},))
+    worker.start()
+    while not finished.done():
+        time.sleep(0.01)
+    ended: set = set()
+    abandon(Executor(), {1: finished, 2: cancelled}, batches, ended)  # type: ignore
+    worker.join(timeout=5)
+    assert not worker.is_alive()
+    assert ended == {1}
+
+
+def dialogue(second: int, text: str) -> str:
+    return f"Dialogue: 0,0:00:0{second}.00,0:00:0{second}.50,Dial_CH,,0,0,0,,{text}\n"
+
+
+@pytest.fixture
+def episode(tmp_path):
+    video = str(tmp_path / "1.mp4")
+    writer = cv2.VideoWriter(video, cv2.VideoWriter_fourcc(*"mp4v"), 24, (64, 48))
+    assert writer.isOpened()
+    for i in range(120):
+        frame = np.full((48, 64, 3), 0, dtype=np.uint8)
+        cv2.putText(
+            frame, str(i // 24), (2, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255)
+        )
+        writer.write(frame)
+    writer.release()
+    sub = tmp_path / "1.ass"
+    sub.write_text(HEADER + dialogue(1, "a") + dialogue(3, "b"), encoding="utf-8")
+    return (1, video, str(sub))
+
+
+def rows(conn):
+    return conn.execute(
+        "SELECT id, subtitle, role FROM storyboards WHERE episode = 1 ORDER BY id"
+    ).fetchall()
+
+
+def test_skips_unchanged_episodes(database, episode):
+    ingest([episode], processes=1)
+    database.execute("UPDATE storyboards SET role = 'r'")
+    database.commit()
+    before = rows(database)
+    assert [subtitle for _, subtitle, _ in before] == ["a", "b"]
+    # Touched but not changed: skipped, and the manifest takes the new mtime
+    # so the next run need not hash the file again.
+    os.utime(episode[2], (1, 1))
+    ingest([episode], processes=1)
+    assert rows(database) == before
+    (mtime,) = database.execute("SELECT sub_mtime FROM ingest_manifest").fetchone()
+    assert mtime == 1
+
+
+def test_replaces_changed_or_forced_episodes(database, episode):
+    ingest([episode], processes=1)
+    database.execute("UPDATE storyboards SET role = 'r'")
+    database.commit()
+    before = rows(database)
+    ingest([episode], processes=1, force=True)
+    forced = rows(database)
+    assert forced != before
+    assert [row[1:] for row in forced] == [row[1:] for row in before]
+    with open(episode[2], "a", encoding="utf-8") as f:
+        f.write(dialogue(4, "c"))
+    ingest([episode], processes=1)
+    # Roles of the lines that survived are kept.
+    assert [row[1:] for row in rows(database)] == [("a", "r"), ("b", "r"), ("c", None)]
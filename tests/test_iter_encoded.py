@@ -0,0 +1,55 @@
+import cv2
+import numpy as np
+import pytest
+
+from mygobase.extract_storyboard import PipelineStats, iter_encoded
+
+FRAMES = 240
+
+
+@pytest.fixture(scope="module")
+def still(tmp_path_factory) -> str:
+    # One picture for the whole clip, so every frame is a duplicate by hash.
+    path = str(tmp_path_factory.mktemp("video") / "still.mp4")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 24, (64, 48))
+    assert writer.isOpened()
+    frame = np.zeros((48, 64, 3), dtype=np.uint8)
+    cv2.rectangle(frame, (8, 8), (40, 30), (255, 255, 255), -1)
+    for _ in range(FRAMES):
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def sources(path: str, frame_nums, **kwargs):
+    stats = PipelineStats()
+    res = {
+        encoded.frame_number: encoded.source_frame
+        for encoded in iter_encoded(
+            path, frame_nums, 2, stats, dedup_distance=4, **kwargs
+        )
+    }
+    assert stats.duplicates == sum(fn != source for fn, source in res.items())
+    return res
+
+
+def test_folds_only_close_lines(still):
+    spans = {
+        10: (0.5, 1.5),
+        30: (1.6, 2.5),
+        # 1.1 seconds after the lines of 10 end, but right after those of 30.
+        60: (2.6, 3.0),
+        200: (7.5, 9.0),
+        220: (9.2, 9.5),
+    }
+    assert sources(still, list(spans), spans=spans) == {
+        10: 10,
+        30: 10,
+        60: 10,
+        200: 200,
+        220: 200,
+    }
+
+
+def test_gap_between_frames_without_lines(still):
+    assert sources(still, [10, 20, 200], dedup_gap=1.0) == {10: 10, 20: 10, 200: 200}
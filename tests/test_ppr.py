@@ -0,0 +1,100 @@
+import json
+from collections import deque
+
+import numpy as np
+
+from mygobase import versions
+from mygobase.edges import collapse_edges
+from mygobase.ppr import PPRIndex
+
+
+def brute_force(conn, alpha: float, hops: int):
+    # Dense alpha * sum over h <= hops of ((1 - alpha) P)^h and the BFS
+    # distance between every pair of entities, ignoring edge direction.
+    entities = {entity for (entity,) in conn.execute("SELECT entity FROM entity")}
+    edges = collapse_edges(conn, entities)
+    names = sorted({name for edge in edges for name in (edge.source, edge.target)})
+    ids = {name: i for i, name in enumerate(names)}
+    weights = np.zeros((len(names), len(names)))
+    for edge in edges:
+        if edge.source != edge.target:
+            weights[ids[edge.source], ids[edge.target]] += edge.weight
+            weights[ids[edge.target], ids[edge.source]] += edge.weight
+    walk = (1 - alpha) * weights / weights.sum(axis=1, keepdims=True)
+    step = np.eye(len(names))
+    scores = alpha * step
+    for _ in range(hops):
+        step = step @ walk
+        scores += alpha * step
+    distances = np.full((len(names), len(names)), -1)
+    for seed in range(len(names)):
+        distances[seed, seed] = 0
+        queue = deque([seed])
+        while queue:
+            node = queue.popleft()
+            for other in np.flatnonzero(weights[node]):
+                if distances[seed, other] < 0:
+                    distances[seed, other] = distances[seed, node] + 1
+                    queue.append(other)
+    return names, scores, distances
+
+
+def test_matches_brute_force(graph_db):
+    names, scores, distances = brute_force(graph_db, 0.15, 3)
+    index = PPRIndex.build(graph_db, alpha=0.15, hops=3, top=len(names), epsilon=0)
+    assert list(index.names) == names
+    for seed in range(len(names)):
+        lo, hi = int(index.indptr[seed]), int(index.indptr[seed + 1])
+        neighbours = index.neighbours[lo:hi]
+        reached = np.flatnonzero(scores[seed] > 0)
+        assert sorted(neighbours.tolist()) == [i for i in reached if i != seed]
+        np.testing.assert_allclose(
+            index.scores[lo:hi], scores[seed, neighbours], rtol=1e-5
+        )
+        assert (index.hops[lo:hi] == distances[seed, neighbours]).all()
+        assert (np.diff(index.scores[lo:hi]) <= 0).all()
+
+
+def test_keeps_top_neighbours(graph_db):
+    names, scores, _ = brute_force(graph_db, 0.15, 3)
+    index = PPRIndex.build(graph_db, alpha=0.15, hops=3, top=3, epsilon=0)
+    for seed in range(len(names)):
+        lo, hi = int(index.indptr[seed]), int(index.indptr[seed + 1])
+        row = scores[seed].copy()
+        row[seed] = 0
+        expected = sorted(range(len(names)), key=lambda i: (-row[i], i))[:3]
+        assert index.neighbours[lo:hi].tolist() == expected
+
+
+def test_expand_sums_over_seeds(graph_db):
+    names, scores, distances = brute_force(graph_db, 0.15, 3)
+    index = PPRIndex.build(graph_db, alpha=0.15, hops=3, top=len(names), epsilon=0)
+    seeds = [0, 1]
+    ranked = index.expand({names[i] for i in seeds}, 2, len(names))
+    expected = {
+        names[i]: sum(scores[seed, i] for seed in seeds if distances[seed, i] <= 2)
+        for i in range(len(names))
+        if i not in seeds and any(0 < distances[seed, i] <= 2 for seed in seeds)
+    }
+    assert dict(ranked).keys() == expected.keys()
+    for name, score in ranked:
+        assert abs(score - expected[name]) < 1e-5
+
+
+def test_stale_index_is_not_used(graph_db):
+    PPRIndex.build(graph_db)
+    index = PPRIndex.open(graph_db)
+    assert index is not None
+    assert isinstance(index.scores, np.memmap)
+    graph_db.execute(
+        "INSERT INTO ner (scene, ner) VALUES (?, ?)",
+        (
+            1000,
+            json.dumps(
+                {"relations": [{"source": "e00", "target": "e01", "relation": "r0"}]}
+            ),
+        ),
+    )
+    versions.bump(graph_db, versions.GRAPH)
+    graph_db.commit()
+    assert PPRIndex.open(graph_db) is None
@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+import pytest
+from cv2 import VideoCapture
+
+from mygobase.extract_storyboard import read_frames
+
+FRAMES = 300
+TARGETS = [3, 40, 41, 120, 121, 250, 299]
+
+
+@pytest.fixture(scope="module")
+def clip(tmp_path_factory) -> str:
+    path = str(tmp_path_factory.mktemp("video") / "clip.mp4")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 24, (64, 48))
+    assert writer.isOpened()
+    for i in range(FRAMES):
+        frame = np.full((48, 64, 3), i % 256, dtype=np.uint8)
+        cv2.putText(frame, str(i), (2, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 0, 0))
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def sequential(path: str):
+    # Every frame in order, no seeking at all.
+    cap = cv2.VideoCapture(path)
+    frames = {}
+    for i in range(FRAMES):
+        ret, frame = cap.read()
+        assert ret
+        if i in TARGETS:
+            frames[i] = frame
+    cap.release()
+    return frames
+
+
+def test_seek_matches_sequential(clip):
+    expected = sequential(clip)
+    frames = dict(read_frames(clip, TARGETS, gop_size=10))
+    assert frames.keys() == expected.keys()
+    for i in TARGETS:
+        assert np.array_equal(frames[i], expected[i]), i
+
+
+class Capture:
+    # Wraps the real capture; cv2.VideoCapture itself cannot be subclassed.
+    def __init__(self, filename: str) -> None:
+        self.cap = VideoCapture(filename)
+
+    def __getattr__(self, name: str):
+        return getattr(self.cap, name)
+
+
+class NoSeek(Capture):
+    def set(self, prop: int, value: float) -> bool:
+        return False
+
+
+class Overshoot(Capture):
+    # Lands a few frames past the one asked for, as an inexact seek may.
+    def set(self, prop: int, value: float) -> bool:
+        return self.cap.set(prop, value + 3)
+
+
+@pytest.mark.parametrize("capture", [NoSeek, Overshoot])
+def test_failed_seek_falls_back(clip, monkeypatch, capture):
+    expected = sequential(clip)
+    monkeypatch.setattr(cv2, "VideoCapture", capture)
+    frames = dict(read_frames(clip, TARGETS, gop_size=10))
+    assert frames.keys() == expected.keys()
+    for i in TARGETS:
+        assert np.array_equal(frames[i], expected[i]), i
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+from mygobase.scene import SCENE_STRIDE, scene_ids
+
+
+def test_scene_ids_are_per_episode():
+    assert scene_ids(3, np.array([0, 0, 1, SCENE_STRIDE - 1])) == [
+        3 * SCENE_STRIDE,
+        3 * SCENE_STRIDE,
+        3 * SCENE_STRIDE + 1,
+        4 * SCENE_STRIDE - 1,
+    ]
+    assert scene_ids(3, np.zeros(0, dtype=np.int64)) == []
+
+
+def test_too_many_scenes_are_refused():
+    with pytest.raises(ValueError):
+        scene_ids(3, np.arange(SCENE_STRIDE + 1))